@@ -1,51 +1,7 @@
 # YALLA SHOPPING POS SYSTEM - PRODUCTION READY v1.0.0
 import streamlit as st
-import pandas as pd
 import time
 
-# Handle imports with error checking (no runtime install to avoid Cloud failures)
-try:
-    import gspread
-    from google.oauth2.service_account import Credentials
-    # Only show success message in development, not in production
-    if st.secrets.get("DEVELOPMENT_MODE", False):
-        st.success("✅ All critical dependencies loaded successfully!")
-except ImportError as e:
-    st.error(f"❌ Import Error: {e}")
-    st.error("🔧 SOLUTION: Clear Streamlit Cloud cache and redeploy!")
-    st.error("Dependencies missing. Ensure requirements.txt includes complete Google Auth ecosystem.")
-    
-    with st.expander("🛠️ Troubleshooting Steps", expanded=True):
-        st.markdown("""
-        **Step 1: Clear Streamlit Cloud Cache**
-        1. Go to your app → Click 'Manage app'
-        2. Settings → Advanced → Clear cache
-        3. Click 'Reboot app'
-        
-        **Step 2: Verify Dependencies**
-        - Check that requirements.txt includes all Google Auth packages
-        - Ensure Python version is 3.11.9 in runtime.txt
-        
-        **Step 3: Force Redeploy**
-        - Make a small change to any file
-        - Commit and push to GitHub
-        """)
-    
-    st.code("pip install -r requirements.txt", language="bash")
-    st.stop()
-
-try:
-    import pytz
-    import base64
-    import random, string, io, json, os
-    from collections.abc import Mapping
-    from datetime import datetime
-    # Set timezone
-    TZ = pytz.timezone("Africa/Cairo")
-except Exception as e:
-    st.error(f"❌ **Unexpected Error:** {e}")
-    st.stop()
-
 st.set_page_config(page_title="Yalla Shopping", page_icon="🛒", layout="wide")
 
 # Password Protection
@@ -94,34 +50,164 @@ def check_password():
 if not check_password():
     st.stop()
 
+# Heavy imports come after the login gate, so the login screen needs nothing but streamlit
+# Handle imports with error checking (no runtime install to avoid Cloud failures)
+try:
+    import pandas as pd
+    import gspread
+    from google.oauth2.service_account import Credentials
+    # Only show success message in development, not in production
+    if st.secrets.get("DEVELOPMENT_MODE", False):
+        st.success("✅ All critical dependencies loaded successfully!")
+except ImportError as e:
+    st.error(f"❌ Import Error: {e}")
+    st.error("🔧 SOLUTION: Clear Streamlit Cloud cache and redeploy!")
+    st.error("Dependencies missing. Ensure requirements.txt includes complete Google Auth ecosystem.")
+    
+    with st.expander("🛠️ Troubleshooting Steps", expanded=True):
+        st.markdown("""
+        **Step 1: Clear Streamlit Cloud Cache**
+        1. Go to your app → Click 'Manage app'
+        2. Settings → Advanced → Clear cache
+        3. Click 'Reboot app'
+        
+        **Step 2: Verify Dependencies**
+        - Check that requirements.txt includes all Google Auth packages
+        - Ensure Python version is 3.11.9 in runtime.txt
+        
+        **Step 3: Force Redeploy**
+        - Make a small change to any file
+        - Commit and push to GitHub
+        """)
+    
+    st.code("pip install -r requirements.txt", language="bash")
+    st.stop()
+
+try:
+    import base64
+    import numpy as np
+    import random, string, io, json, os
+    import threading, hashlib
+    from collections.abc import Mapping
+    from datetime import datetime
+    # Storage engine (no Streamlit inside; also sets copy-on-write and the Cairo timezone)
+    from pos_core import (
+        TZ, SCHEMAS, NUMERIC_COLS, DATETIME_FORMAT, KEY_COLUMNS,
+        API_REQUESTS_PER_MINUTE, PRIORITY_NORMAL, PRIORITY_LOW, RateLimiter, GuardedClient,
+        SheetsStorage, SQLiteStorage, DAILY_SALES_BUILT_KEY,
+        Outbox, WriteCoalescer, COALESCE_TIMEOUT, SHEET_CACHE_MAX_MB, SnapshotStore, SheetCache, _type_frame,
+        ReportCube, CustomerSearchIndex,
+    )
+except Exception as e:
+    st.error(f"❌ **Unexpected Error:** {e}")
+    st.stop()
+
+# ---------- Assets ----------
+# Images are kept once under their content hash and served as pre-resized, memoized variants.
+# Uploaded ones live in the Assets sheet, base64 split into chunks that fit a cell.
+ASSET_CHUNK_CHARS = 45000  # A Sheets cell holds at most 50,000 characters
+ASSET_MAX_SIZE = (800, 800)  # Uploads are scaled down to this before they are stored
+LOGO_VARIANTS = {"header": (400, 400), "invoice": (400, 200), "thumb": (150, 150)}
+
+def asset_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:32]
+
+def png_fit(data: bytes, size) -> bytes:
+    """The image scaled down to fit `size`, as PNG; raises if Pillow cannot read it."""
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as img:
+        img.thumbnail(size, Image.LANCZOS)
+        if img.mode not in ("1", "L", "LA", "P", "RGB", "RGBA"):
+            img = img.convert("RGBA")
+        out = io.BytesIO()
+        img.save(out, format="PNG", optimize=True)
+    return out.getvalue()
+
+def normalize_image(data: bytes) -> bytes:
+    """PNG no larger than ASSET_MAX_SIZE; the bytes unchanged if Pillow cannot read them."""
+    try:
+        return png_fit(data, ASSET_MAX_SIZE)
+    except Exception:
+        return data
+
+class AssetStore:
+    """Image bytes by content hash and their encoded variants, shared by all sessions."""
+    def __init__(self):
+        self.originals = {}
+        self.variants = {}
+        self.files = {}
+        self.encoded = {}
+        self.lock = threading.Lock()
+
+    def add(self, data):
+        digest = asset_digest(data)
+        with self.lock:
+            self.originals.setdefault(digest, data)
+        return digest
+
+    def add_file(self, path):
+        """Hash of the image file at `path` (read once per process); None if it does not exist."""
+        if path not in self.files:
+            try:
+                with open(path, "rb") as file:
+                    self.files[path] = self.add(file.read())
+            except FileNotFoundError:
+                self.files[path] = None
+        return self.files[path]
+
+    def add_encoded(self, encoded):
+        """Hash of a base64 image (decoded once per distinct value); "" if it is not valid base64."""
+        if encoded not in self.encoded:
+            try:
+                self.encoded[encoded] = self.add(base64.b64decode(encoded))
+            except ValueError:
+                self.encoded[encoded] = ""
+        return self.encoded[encoded]
+
+    def variant(self, digest, name):
+        """data: URI of the image scaled to fit LOGO_VARIANTS[name]; "" if the hash is unknown."""
+        with self.lock:
+            uri = self.variants.get((digest, name))
+            data = self.originals.get(digest)
+        if uri is not None or data is None:
+            return uri or ""
+        try:
+            png = png_fit(data, LOGO_VARIANTS[name])
+        except Exception:
+            # Not something Pillow can read; let the browser try the original
+            png = data
+        uri = "data:image/png;base64," + base64.b64encode(png).decode()
+        with self.lock:
+            self.variants[(digest, name)] = uri
+        return uri
+
+@st.cache_resource(show_spinner=False)
+def get_asset_store():
+    return AssetStore()
+
+def asset_uri(digest, variant):
+    return get_asset_store().variant(digest, variant) if digest else ""
+
 def load_logo():
-    """Load and return logo as base64 string"""
+    """Hash of the logo file shipped in assets/, or None"""
     logo_paths = [
         "assets/logo_yalla_shopping.png",  # New logo
         "assets/logo_waadlash.jpg",        # Fallback logo
     ]
     
     for logo_path in logo_paths:
-        try:
-            with open(logo_path, "rb") as file:
-                logo_bytes = file.read()
-                return base64.b64encode(logo_bytes).decode()
-        except FileNotFoundError:
-            continue
+        digest = get_asset_store().add_file(logo_path)
+        if digest:
+            return digest
     return None
 
 def display_app_header():
     """Display app header with logo and title"""
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
-        logo_b64 = load_logo()
-        if logo_b64:
-            # Determine image type based on first few bytes or file extension
-            if logo_b64.startswith('/9j/') or logo_b64.startswith('iVBOR'):
-                mime_type = "image/png" if logo_b64.startswith('iVBOR') else "image/jpeg"
-                st.image(f"data:{mime_type};base64,{logo_b64}", width=200)
-            else:
-                st.image(f"data:image/png;base64,{logo_b64}", width=200)
+        logo_src = asset_uri(load_logo(), "header")
+        if logo_src:
+            st.image(logo_src, width=200)
         else:
             st.title("🛒 Yalla Shopping")
         
@@ -133,33 +219,16 @@ display_app_header()
 
 st.markdown("---")
 
-SCHEMAS = {
-    "Products": ["SKU","Name","RetailPrice","InStock","LowStockThreshold","Active","Notes"],
-    "Customers": ["CustomerID","Name","Phone","Address","Notes"],
-    "Orders": ["OrderID","DateTime","CustomerID","CustomerName","CustomerAddress","Channel","Subtotal","Discount","Delivery","Deposit","Total","Status","Notes"],
-    "OrderItems": ["OrderID","SKU","Name","Qty","UnitPrice","LineTotal"],
-    "StockMovements": ["Timestamp","SKU","Change","Reason","Reference","Note"],
-    "Settings": ["Key","Value"]
-}
-
 # ---------- Quota Management ----------
+@st.cache_resource(show_spinner=False)
+def get_rate_limiter():
+    """One limiter per process: the API quota belongs to the service account, not the session."""
+    return RateLimiter(API_REQUESTS_PER_MINUTE)
+
 def check_api_quota():
-    """Check if we're hitting API limits and show appropriate message"""
-    if "api_calls_count" not in st.session_state:
-        st.session_state.api_calls_count = 0
-        st.session_state.last_reset = time.time()
-    
-    # Reset counter every minute
-    if time.time() - st.session_state.last_reset > 60:
-        st.session_state.api_calls_count = 0
-        st.session_state.last_reset = time.time()
-    
-    # Warn if approaching limit
-    if st.session_state.api_calls_count > 45:
+    """Warn when the shared API budget is nearly used up"""
+    if load_storage_backend() == "sheets" and get_rate_limiter().tight(PRIORITY_NORMAL):
         st.warning("⚠️ اقتراب من حد استخدام API. تجنب تحديث الصفحة بكثرة.")
-        time.sleep(1)  # Small delay to prevent rapid requests
-    
-    st.session_state.api_calls_count += 1
 
 # ---------- Helpers ----------
 def get_setting(settings_df, key, default: str = "") -> str:
@@ -167,6 +236,108 @@ def get_setting(settings_df, key, default: str = "") -> str:
         return settings_df.loc[settings_df["Key"]==key, "Value"].iloc[0]
     return default
 
+def load_settings():
+    """Settings as {key: value}; built once per cached version of the sheet and shared by all sessions."""
+    def build(df):
+        values = {}
+        for key, value in zip(df["Key"], df["Value"]):
+            values.setdefault(key, value)
+        return values
+    return get_sheet_cache().derive(storage, "Settings", "by_key", build)
+
+def _orders_by_time(df):
+    # Sorted by local wall-clock time, the same clock .dt.date uses for report days
+    local = df["DateTime"].dt.tz_localize(None)
+    order = np.argsort(local.array.asi8, kind="stable")
+    return df.take(order).reset_index(drop=True), local.array.asi8[order]
+
+def _extend_orders_by_time(value, df, start):
+    ordered, stamps = value
+    added, added_stamps = _orders_by_time(df.iloc[start:])
+    if len(stamps) and len(added_stamps) and added_stamps[0] < stamps[-1]:
+        return None  # A back-dated order; sort again
+    return pd.concat([ordered, added], ignore_index=True), np.concatenate([stamps, added_stamps])
+
+def orders_in_range(start, end):
+    """Orders dated start..end (inclusive), sliced from the time-sorted Orders by binary search."""
+    ordered, stamps = get_sheet_cache().derive(storage, "Orders", "by_time", _orders_by_time,
+                                               _extend_orders_by_time)
+    lo = pd.Timestamp(start).value
+    hi = (pd.Timestamp(end) + pd.Timedelta(days=1)).value
+    first, last = np.searchsorted(stamps, [lo, hi])
+    return ordered.iloc[first:last]
+
+def _rows_by(name, col):
+    """(typed frame, {value: row positions}) for a sheet, built once per cached version.
+
+    Appended rows are added to the positions of the previous version, so the
+    index always matches the frame it came with.
+    """
+    def build(df):
+        return df, df.groupby(col, sort=False).indices
+    def extend(value, df, start):
+        positions = dict(value[1])
+        for key, found in df.iloc[start:].groupby(col, sort=False).indices.items():
+            found = found + start
+            positions[key] = np.concatenate([positions[key], found]) if key in positions else found
+        return df, positions
+    return get_sheet_cache().derive(storage, name, f"rows_by_{col}", build, extend)
+
+def items_for_orders(order_ids):
+    """OrderItems rows of `order_ids`, looked up through the OrderID index."""
+    items, positions = _rows_by("OrderItems", "OrderID")
+    found = [positions[order_id] for order_id in order_ids if order_id in positions]
+    return items.take(np.sort(np.concatenate(found))) if found else items.iloc[0:0]
+
+def orders_for_customer(customer_id):
+    """Orders of one customer, looked up through the CustomerID index."""
+    orders, positions = _rows_by("Orders", "CustomerID")
+    found = positions.get(customer_id)
+    return orders.take(found) if found is not None else orders.iloc[0:0]
+
+def _asset_chunks(df):
+    parts = {}
+    for digest, part, data in zip(df["Hash"], df["Part"], df["Data"]):
+        parts.setdefault(digest, {})[int(part or 0)] = data
+    return {digest: "".join(chunks[i] for i in sorted(chunks)) for digest, chunks in parts.items()}
+
+def load_asset(digest):
+    """Make sure the asset `digest` is in the asset store, reading the Assets sheet if needed."""
+    store = get_asset_store()
+    if digest in store.originals:
+        return True
+    encoded = get_sheet_cache().derive(storage, "Assets", "by_hash", _asset_chunks).get(digest)
+    return bool(encoded) and store.add_encoded(encoded) == digest
+
+def save_asset(data):
+    """Store an image once under its content hash in the Assets sheet and return the hash."""
+    data = normalize_image(data)
+    digest = get_asset_store().add(data)
+    if digest not in get_sheet_cache().derive(storage, "Assets", "by_hash", _asset_chunks):
+        encoded = base64.b64encode(data).decode()
+        rows = [[digest, str(i), encoded[pos:pos + ASSET_CHUNK_CHARS]]
+                for i, pos in enumerate(range(0, len(encoded), ASSET_CHUNK_CHARS))]
+        append_df(ws_map["Assets"], pd.DataFrame(rows, columns=SCHEMAS["Assets"]))
+    return digest
+
+def resolve_logo(settings):
+    """Hash of the uploaded shop logo, loaded into the asset store; "" if there is none."""
+    digest = settings.get("BusinessLogo", "")
+    if digest:
+        return digest if load_asset(digest) else ""
+    # Logos saved before the Assets sheet are a base64 Settings cell
+    legacy = settings.get("BusinessLogoB64", "")
+    return get_asset_store().add_encoded(legacy) if legacy else ""
+
+def rebuild_daily_sales():
+    """Fill DailySales in for orders recorded before the sheet existed (once; see storage.rebuild_daily_sales).
+
+    Checkouts keep DailySales current on their own (see storage.commit).
+    """
+    storage.rebuild_daily_sales()
+    # Written straight to storage, not through the cache; read both sheets again
+    get_sheet_cache().invalidate(storage.key, ["DailySales", "Settings"])
+
 def _coerce_to_plain_dict(value):
     """Return a plain dict from Streamlit AttrDict/dict or JSON string."""
     if isinstance(value, (dict, Mapping)):
@@ -270,7 +441,9 @@ def get_gspread_client(_sa_info: dict):
             "https://www.googleapis.com/auth/drive",
         ]
         credentials = Credentials.from_service_account_info(_sa_info, scopes=scopes)
-        return gspread.authorize(credentials)
+        client = GuardedClient(auth=credentials)
+        client.limiter = get_rate_limiter()
+        return client
         
     except Exception as e:
         st.error(f"❌ خطأ في إنشاء اتصال Google Sheets: {str(e)}")
@@ -298,98 +471,104 @@ def get_gspread_client(_sa_info: dict):
                 """)
         st.stop()
 
-def ensure_worksheet(sh, name):
+@st.cache_resource(show_spinner=False)
+def get_spreadsheet(_client, spreadsheet_id: str):
+    """Open the spreadsheet once per process; open_by_key costs a metadata read on every call."""
+    return _client.open_by_key(spreadsheet_id)
+
+@st.cache_resource(show_spinner=False)
+def get_validated_worksheets():
+    """Worksheets whose header row matched SCHEMAS, keyed by (spreadsheet id, name).
+
+    Shared by all sessions so the header check runs once per process; entries
+    are dropped by storage.ensure() (schema repair) and storage.forget_checks() ("فحص النظام").
+    """
+    return {}
+
+# ---------- Storage Backends ----------
+def _config(name, default):
+    """A setting from secrets, then environment variables, else `default`."""
+    value = str(st.secrets.get(name, "")).strip()
+    if not value:
+        value = os.environ.get(name, "").strip()
+    return value or default
+
+def load_storage_backend():
+    """Read the storage backend ("sheets" or "sqlite") from secrets or environment variables."""
+    return _config("STORAGE_BACKEND", "sheets").lower()
+
+def load_sqlite_path():
+    """Read the SQLite database path from secrets or environment variables."""
+    return _config("SQLITE_PATH", "data/yalla_pos.db")
+
+@st.cache_resource(show_spinner=False)
+def get_sqlite_storage(path: str):
+    """Open (and create if needed) the SQLite database once per process."""
+    return SQLiteStorage(path)
+
+# ---------- Write-behind Outbox ----------
+def load_outbox_path():
+    """Read the outbox database path from secrets or environment variables."""
+    return _config("OUTBOX_PATH", "data/outbox.db")
+
+@st.cache_resource(show_spinner=False)
+def get_outbox(path: str):
+    """Open the outbox and start its flusher thread once per process."""
+    return Outbox(path)
+
+# ---------- Write Coalescer ----------
+
+@st.cache_resource(show_spinner=False)
+def get_write_coalescer():
+    """One writer thread per process, shared by all sessions."""
+    return WriteCoalescer(get_sheet_cache(), get_rate_limiter())
+
+def submit_write(appends=None, cell_updates=(), stock_deltas=None, rewrite=None):
+    """Queue a write in the process-wide coalescer and wait until it is stored."""
+    future = get_write_coalescer().submit(storage, appends, cell_updates, stock_deltas, rewrite)
+    future.result(timeout=COALESCE_TIMEOUT)
+
+# ---------- Sheet Cache ----------
+def load_sheet_cache_budget():
+    """Read the sheet cache memory budget in MB from secrets or environment variables.
+
+    A value that is not a positive number falls back to SHEET_CACHE_MAX_MB.
+    """
     try:
-        ws = sh.worksheet(name)
-        # Verify the worksheet has proper headers
-        try:
-            all_values = ws.get_all_values()
-            expected_headers = SCHEMAS[name]
-            
-            if not all_values:
-                # Empty worksheet, add headers
-                ws.update(values=[expected_headers], range_name=f"A1:{chr(64+len(expected_headers))}1")
-            else:
-                first_row = all_values[0]
-                # Check for duplicate headers or wrong headers
-                has_duplicates = len(first_row) != len(set(first_row)) and any(first_row)
-                headers_wrong = (len(first_row) < len(expected_headers) or 
-                               not all(first_row[i] == expected_headers[i] for i in range(min(len(first_row), len(expected_headers)))))
-                
-                if has_duplicates or headers_wrong:
-                    # Keep existing data but fix headers
-                    if len(all_values) > 1:
-                        data_rows = all_values[1:]
-                        ws.clear()
-                        ws.update(values=[expected_headers], range_name=f"A1:{chr(64+len(expected_headers))}1")
-                        if data_rows:
-                            # Ensure data fits schema
-                            formatted_data = []
-                            for row in data_rows:
-                                # Skip empty rows
-                                if any(cell.strip() for cell in row if cell):
-                                    formatted_row = row[:len(expected_headers)] + [''] * max(0, len(expected_headers) - len(row))
-                                    formatted_data.append(formatted_row)
-                            if formatted_data:
-                                end_col = chr(64 + len(expected_headers))
-                                end_row = len(formatted_data) + 1
-                                ws.update(values=formatted_data, range_name=f"A2:{end_col}{end_row}")
-                    else:
-                        ws.clear()
-                        ws.update(values=[expected_headers], range_name=f"A1:{chr(64+len(expected_headers))}1")
-                        
-        except Exception as e:
-            st.warning(f"تحذير: مشكلة في تحديث رؤوس الأعمدة لورقة {name}: {str(e)}")
-            
-    except gspread.exceptions.WorksheetNotFound:
-        try:
-            ws = sh.add_worksheet(title=name, rows=1000, cols=30)
-            header = SCHEMAS[name]
-            ws.update(values=[header], range_name=f"A1:{chr(64+len(header))}1")
-        except Exception as e:
-            st.error(f"خطأ في إنشاء ورقة {name}: {str(e)}")
-            st.stop()
-    return ws
+        megabytes = float(_config("SHEET_CACHE_MAX_MB", SHEET_CACHE_MAX_MB))
+    except ValueError:
+        megabytes = SHEET_CACHE_MAX_MB
+    if not 0 < megabytes < float("inf"):
+        megabytes = SHEET_CACHE_MAX_MB
+    return int(megabytes * 1024 * 1024)
+
+def load_snapshot_dir():
+    """Read the sheet snapshot folder from secrets or environment variables."""
+    return _config("SNAPSHOT_DIR", "data/snapshots")
+
+@st.cache_resource(show_spinner=False)
+def get_sheet_cache():
+    return SheetCache(load_sheet_cache_budget(), SnapshotStore(load_snapshot_dir()))
 
-@st.cache_data(ttl=300, show_spinner=False)  # Increased cache time to 5 minutes
 def _read_df_cached(ws_title: str, expected_cols_tuple: tuple):
     try:
-        ws = ws_map[ws_title]
         expected_cols = list(expected_cols_tuple)
+        df, version = get_sheet_cache().typed_at(storage, ws_title)
+        if not get_sheet_cache().header_ok(storage.key, ws_title):
+            st.warning(f"⚠️ رؤوس الأعمدة لورقة {ws_title} تحتاج إصلاح. استخدم 'فحص النظام' لإصلاحها.")
         
-        # Use batch request to get all data at once
-        all_values = ws.get_all_values()
+        # Ensure all expected columns exist (the cached frame is shared; copy-on-write keeps it intact)
+        missing = [c for c in expected_cols if c not in df.columns]
+        if missing:
+            filler = _type_frame(ws_title, pd.DataFrame({c: [""] * len(df) for c in missing}, index=df.index))
+            df = pd.concat([df, filler], axis=1)
         
-        if not all_values or len(all_values) < 1:
-            # Return empty dataframe with expected columns
-            expected_headers = SCHEMAS[ws_title]
-            df = pd.DataFrame(columns=expected_headers)
-        else:
-            expected_headers = SCHEMAS[ws_title]
-            first_row = all_values[0]
-            
-            # Check if headers match - if not, use expected headers
-            if len(first_row) >= len(expected_headers) and all(first_row[i] == expected_headers[i] for i in range(len(expected_headers))):
-                # Headers match, parse data normally
-                if len(all_values) > 1:
-                    data_rows = all_values[1:]
-                    df = pd.DataFrame(data_rows, columns=expected_headers[:len(first_row)])
-                else:
-                    df = pd.DataFrame(columns=expected_headers)
-            else:
-                # Headers don't match, create empty dataframe and warn
-                st.warning(f"⚠️ رؤوس الأعمدة لورقة {ws_title} تحتاج إصلاح. استخدم 'فحص النظام' لإصلاحها.")
-                df = pd.DataFrame(columns=expected_headers)
-        
-        # Ensure all expected columns exist
-        for c in expected_cols:
-            if c not in df.columns:
-                df[c] = "" if c not in ["RetailPrice","InStock","LowStockThreshold","Subtotal","Discount","Delivery","Deposit","Total","Qty","UnitPrice","LineTotal"] else 0
-        
-        # Return only the expected columns in the right order
+        # Return only the expected columns in the right order (a new frame sharing the cached data)
         result_df = df[expected_cols]
         if isinstance(result_df, pd.Series):
             result_df = result_df.to_frame().T
+        # write_df diffs an edited frame against this version of the sheet
+        result_df.attrs["version"] = version
         return result_df
         
     except Exception as e:
@@ -401,108 +580,185 @@ def _read_df_cached(ws_title: str, expected_cols_tuple: tuple):
         else:
             st.error(f"خطأ في قراءة ورقة {ws_title}: {str(e)}")
             # Return empty dataframe with expected schema
-            return pd.DataFrame(columns=expected_cols_tuple)
-
-def _coerce_numeric(df: pd.DataFrame, cols):
-    df_copy = df.copy()
-    for c in cols:
-        if c in df_copy.columns:
-            df_copy[c] = pd.to_numeric(df_copy[c], errors="coerce").fillna(0)
-    return df_copy
-
-def _coerce_str(df: pd.DataFrame, cols):
-    df_copy = df.copy()
-    for c in cols:
-        if c in df_copy.columns:
-            df_copy[c] = df_copy[c].astype(str)
-    return df_copy
+            return _type_frame(ws_title, pd.DataFrame(columns=expected_cols_tuple))
+
+def preload_sheets(names):
+    """Refresh the cached frames of several sheets with one batched read."""
+    if not names:
+        return
+    try:
+        get_sheet_cache().load(storage, list(names))
+    except Exception as e:
+        if "quota" in str(e).lower() or "rate_limit" in str(e).lower():
+            st.error("🚫 تم تجاوز حد استخدام Google Sheets API")
+            st.info("⏳ انتظر 2-3 دقائق ثم أعد تحميل الصفحة")
+            st.stop()
+        # Anything else is reported per sheet by read_df
 
 def read_df(ws, expected_cols, schema_name=None):
-    # Use worksheet title as the cache key to reduce API reads
-    df = _read_df_cached(ws.title, tuple(expected_cols)).copy()
-    # Normalize types for reliable arithmetic and concatenation
-    if schema_name == "Products":
-        df = _coerce_str(df, ["SKU","Name","Active","Notes"]) 
-        df = _coerce_numeric(df, ["RetailPrice","InStock","LowStockThreshold"])
-        df = df.astype({"InStock":"int64","LowStockThreshold":"int64"})
-    elif schema_name == "Customers":
-        df = _coerce_str(df, ["CustomerID","Name","Phone","Address","Notes"]) 
-    elif schema_name == "Orders":
-        df = _coerce_str(df, ["OrderID","DateTime","CustomerID","CustomerName","CustomerAddress","Channel","Status","Notes"]) 
-        df = _coerce_numeric(df, ["Subtotal","Discount","Delivery","Deposit","Total"]) 
-    elif schema_name == "OrderItems":
-        df = _coerce_str(df, ["OrderID","SKU","Name"]) 
-        df = _coerce_numeric(df, ["Qty","UnitPrice","LineTotal"])
-        df = df.astype({"Qty":"int64"})
-    elif schema_name == "StockMovements":
-        df = _coerce_str(df, ["Timestamp","SKU","Reason","Reference","Note"]) 
-        df = _coerce_numeric(df, ["Change"])
-        df = df.astype({"Change":"int64"})
-    return df
+    # Typed once per cached version from DTYPES (schema_name is kept for older callers)
+    # and shared by all sessions; edits by the caller copy on write and never reach the cache
+    return _read_df_cached(ws.title, tuple(expected_cols))
+
+def _df_to_rows(ws_name, df):
+    """Conform a dataframe to the sheet schema and return (header, rows) as strings."""
+    if ws_name in SCHEMAS:
+        expected_cols = SCHEMAS[ws_name]
+        # Add missing columns on a new frame; the caller's frame (often a shared cached one) is left alone
+        missing = {col: "" if col not in NUMERIC_COLS else 0 for col in expected_cols if col not in df.columns}
+        if missing:
+            df = df.assign(**missing)
+        # Reorder columns to match schema
+        df = df[expected_cols]
+    
+    # Convert to string and handle NaN values; datetimes go back as naive Cairo wall-clock text
+    columns = {}
+    for col in df.columns:
+        values = df[col]
+        if isinstance(values.dtype, pd.DatetimeTZDtype):
+            values = values.dt.tz_convert(TZ).dt.strftime(DATETIME_FORMAT)
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype(object)
+        columns[col] = values.fillna('').astype(str)
+    df_str = pd.DataFrame(columns, index=df.index, columns=df.columns)
+    return df_str.columns.tolist(), df_str.values.tolist()
+
+def _same_cell(col, old, new):
+    if old == new:
+        return True
+    if col in NUMERIC_COLS:
+        try:
+            return float(old or 0) == float(new or 0)
+        except ValueError:
+            return False
+    return False
+
+def _diff_changes(ws_name, snapshot, df):
+    """Compare `df` with the raw frame of the version it was read from.
+
+    Rows keep their position from read_df, so row i of `df` must carry the
+    same key as row i of the snapshot; extra rows at the end are new. Returns
+    (rows to append, [(sheet, row_pos, column, value)]) or None when rows
+    were removed or reordered and the sheet has to be rewritten.
+    """
+    cols = SCHEMAS[ws_name]
+    key_idx = cols.index(KEY_COLUMNS[ws_name])
+    _, rows = _df_to_rows(ws_name, df)
+    old_rows = snapshot[cols].values.tolist()
+    if len(rows) < len(old_rows):
+        return None
+    cell_updates = []
+    for pos, (old, new) in enumerate(zip(old_rows, rows)):
+        if old[key_idx] != new[key_idx]:
+            return None
+        for ci, col in enumerate(cols):
+            if not _same_cell(col, old[ci], new[ci]):
+                cell_updates.append((ws_name, pos, col, new[ci]))
+    return rows[len(old_rows):], cell_updates
 
 def write_df(ws, df):
     try:
-        # Clear the worksheet first
-        ws.clear()
+        ws_name = ws.title
+        if ws_name in KEY_COLUMNS and not df.empty:
+            cache = get_sheet_cache()
+            snapshot, version = cache.snapshot(storage.key, ws_name)
+            # Diff against the version the frame was read at (read_df stamps it), so cells other
+            # terminals or sales changed since then are left alone instead of being written back
+            base_version = df.attrs.get("version", version)
+            base = snapshot if base_version == version else cache.base(storage.key, ws_name, base_version)
+            changes = _diff_changes(ws_name, base, df) if snapshot is not None and base is not None else None
+            if changes is not None:
+                new_rows, cell_updates = changes
+                key_col = SCHEMAS[ws_name].index(KEY_COLUMNS[ws_name])
+                if any(pos >= len(snapshot) or snapshot.iat[pos, key_col] != base.iat[pos, key_col] for _, pos, _, _ in cell_updates):
+                    raise RuntimeError(f"تغيرت بيانات {ws_name} على جهاز آخر، أعد تحميل الصفحة وحاول مرة أخرى")
+                stock_deltas = {}
+                if ws_name == "Products":
+                    # Stock edits go through the conflict-checked delta path, like sales; the delta
+                    # is what this edit changed, so sales since the read still count
+                    stock_col = SCHEMAS["Products"].index("InStock")
+                    for _, pos, col, value in [u for u in cell_updates if u[2] == "InStock"]:
+                        sku = str(base.iat[pos, 0])
+                        old = base.iat[pos, stock_col]
+                        stock_deltas[sku] = stock_deltas.get(sku, 0) + int(float(value or 0)) - int(float(old or 0))
+                    cell_updates = [u for u in cell_updates if u[2] != "InStock"]
+                if new_rows or cell_updates or stock_deltas:
+                    # Changed cells and new rows in one request
+                    submit_write({ws_name: new_rows}, cell_updates, stock_deltas)
+                return
+            if base_version != version:
+                # Rows were removed or reordered: a full rewrite would undo what changed since the read
+                raise RuntimeError(f"تغيرت بيانات {ws_name} على جهاز آخر، أعد تحميل الصفحة وحاول مرة أخرى")
+        
         if df.empty:
             # Even if empty, write headers
             ws_name = ws.title
-            if ws_name in SCHEMAS:
-                headers = SCHEMAS[ws_name]
-                ws.update(values=[headers], range_name=f"A1:{chr(64+len(headers))}1")
+            submit_write(rewrite=(ws_name, [SCHEMAS[ws_name]] if ws_name in SCHEMAS else []))
             return
         
         # Ensure dataframe has the right columns in the right order
-        ws_name = ws.title
-        if ws_name in SCHEMAS:
-            expected_cols = SCHEMAS[ws_name]
-            # Add missing columns
-            for col in expected_cols:
-                if col not in df.columns:
-                    df[col] = "" if col not in ["RetailPrice","InStock","LowStockThreshold","Subtotal","Discount","Delivery","Deposit","Total","Qty","UnitPrice","LineTotal"] else 0
-            # Reorder columns to match schema
-            df = df[expected_cols]
-        
-        # Convert to string and handle NaN values
-        df_str = df.fillna('').astype(str)
-        values = [df_str.columns.tolist()] + df_str.values.tolist()
-        
-        # Update the worksheet
-        end_col = chr(64 + len(values[0]))
-        end_row = len(values)
-        ws.update(values=values, range_name=f"A1:{end_col}{end_row}")
+        header, rows = _df_to_rows(ws.title, df)
+        submit_write(rewrite=(ws.title, [header] + rows))
         
     except Exception as e:
         st.error(f"خطأ في كتابة البيانات: {str(e)}")
         raise e
 
+def append_df(ws, df):
+    """Append new rows after the last row of a ledger sheet.
+
+    Used for the append-only sheets (Orders, OrderItems, StockMovements) so a
+    sale only sends its own rows instead of clearing and rewriting the whole
+    history.
+    """
+    if df.empty:
+        return
+    try:
+        _, rows = _df_to_rows(ws.title, df)
+        submit_write({ws.title: rows})
+    except Exception as e:
+        st.error(f"خطأ في إضافة البيانات: {str(e)}")
+        raise e
+
+def commit_checkout(order_id, appends, stock_deltas):
+    """Record a whole POS checkout in the write-behind outbox.
+
+    `appends` maps sheet name -> dataframe of new rows (Customers, Orders,
+    OrderItems, StockMovements) and `stock_deltas` maps SKU -> InStock
+    change. The sale is durable as soon as this returns; the outbox thread
+    writes it to storage as one transaction (a single spreadsheets.batchUpdate
+    on Google Sheets) together with any other pending orders.
+    """
+    rows_by_sheet = {}
+    for ws_name, df in appends.items():
+        if df is not None and not df.empty:
+            rows_by_sheet[ws_name] = _df_to_rows(ws_name, df)[1]
+    try:
+        outbox.enqueue(order_id, rows_by_sheet, stock_deltas)
+    except Exception as e:
+        st.error(f"خطأ في حفظ الطلب: {str(e)}")
+        raise e
+
+def commit_stock_change(appends, stock_deltas):
+    """Write ledger rows and InStock deltas together, right away.
+
+    Used for manual stock movements; the deltas are applied to fresh stock
+    values with the same conflict checks as checkout (see storage.commit).
+    """
+    rows_by_sheet = {}
+    for ws_name, df in appends.items():
+        if df is not None and not df.empty:
+            rows_by_sheet[ws_name] = _df_to_rows(ws_name, df)[1]
+    try:
+        submit_write(rows_by_sheet, [], stock_deltas)
+    except Exception as e:
+        st.error(f"خطأ في تحديث المخزون: {str(e)}")
+        raise e
+
 def validate_worksheet_data(ws_name):
     """Validate and fix worksheet structure if needed"""
     try:
-        ws = ws_map[ws_name]
-        expected_headers = SCHEMAS[ws_name]
-        
-        # Get current data
-        all_values = ws.get_all_values()
-        if not all_values:
-            # Empty worksheet, add headers
-            ws.update(values=[expected_headers], range_name=f"A1:{chr(64+len(expected_headers))}1")
-            return True
-            
-        first_row = all_values[0]
-        
-        # Check for issues
-        has_duplicates = len(first_row) != len(set(first_row)) and any(first_row)
-        headers_wrong = (len(first_row) < len(expected_headers) or 
-                        not all(first_row[i] == expected_headers[i] for i in range(min(len(first_row), len(expected_headers)))))
-        
-        if has_duplicates or headers_wrong:
-            st.warning(f"إصلاح بنية البيانات لورقة {ws_name}")
-            # Fix the worksheet
-            ensure_worksheet(ws_map.sh, ws_name)
-            return True
-            
-        return True
+        return storage.validate(ws_name)
     except Exception as e:
         st.error(f"خطأ في التحقق من ورقة {ws_name}: {str(e)}")
         return False
@@ -511,10 +767,10 @@ def gen_id(prefix):
     now = datetime.now(TZ).strftime("%Y%m%d%H%M%S")
     return f"{prefix}{now}{''.join(random.choices(string.digits, k=4))}"
 
-def invoice_html(order_row, items_df, business_name="Yalla Shopping", business_phone="", business_addr="", logo_b64=""):
+def invoice_html(order_row, items_df, business_name="Yalla Shopping", business_phone="", business_addr="", logo_src=""):
     # Use the new logo if no logo is provided
-    if not logo_b64:
-        logo_b64 = load_logo()
+    if not logo_src:
+        logo_src = asset_uri(load_logo(), "invoice")
     order_meta = {k: order_row[k] for k in order_row.index}
     
     # Get customer address from the order data
@@ -596,7 +852,7 @@ hr {{ border: none; border-top: 1px dashed #aaa; margin: 16px 0; }}
     </div>
     <div class="right">
       <div class="logo-container">
-        {f'<img src="data:image/png;base64,{logo_b64}" class="logo" alt="Yalla Shopping Logo" />' if logo_b64 else '<div class="logo-placeholder">🛒 Yalla Shopping<br><small>Py Saso Mostafa</small></div>'}
+        {f'<img src="{logo_src}" class="logo" alt="Yalla Shopping Logo" />' if logo_src else '<div class="logo-placeholder">🛒 Yalla Shopping<br><small>Py Saso Mostafa</small></div>'}
       </div>
       <div><b>{business_name}</b></div>
       <div class="small">{business_phone}</div>
@@ -650,66 +906,162 @@ hr {{ border: none; border-top: 1px dashed #aaa; margin: 16px 0; }}
 """
     return html
 
+# ---------- Report Cube ----------
+@st.cache_resource(show_spinner=False)
+def get_report_cube():
+    """One cube per process, shared by all sessions."""
+    return ReportCube(get_sheet_cache())
+
+def sales_report(start, end):
+    """Report tables for start..end, summed from the cube slices of that range.
+
+    Customers are not a cube dimension, so top customers come from the
+    date-sliced Orders (see orders_in_range).
+    """
+    state = get_report_cube().refresh(storage)
+    items = ReportCube.slice(state["items"], start, end)
+    orders = ReportCube.slice(state["orders"], start, end)
+    order_count = int(orders["Orders"].sum())
+    total_sales = float(orders["Total"].sum())
+    sold_qty = int(items["Qty"].sum())
+
+    by_channel = orders.groupby("Channel", as_index=False)[["Orders", "Total"]].sum().sort_values("Total", ascending=False)
+    by_hour = orders.groupby("Hour", as_index=False)[["Orders", "Total"]].sum()
+    days = pd.to_datetime(orders["Date"])
+    by_weekday = (orders.assign(Day=days.dt.dayofweek, Weekday=days.dt.day_name())
+                  .groupby(["Day", "Weekday"], as_index=False)[["Orders", "Total"]].sum()
+                  .drop(columns="Day"))
+    per_sku = items.groupby("SKU", as_index=False)[["Qty", "Revenue"]].sum().rename(columns={"Qty": "SoldQty"})
+    per_sku.insert(1, "Name", per_sku["SKU"].map(state["names"]))
+    per_sku = per_sku.sort_values("Revenue", ascending=False)
+
+    sel_orders = orders_in_range(start, end)
+    top_customers = (sel_orders.groupby(["CustomerID", "CustomerName"], as_index=False, observed=True)
+                     .agg(Orders=("OrderID", "size"), Total=("Total", "sum"))
+                     .nlargest(10, "Total"))
+    return {
+        "summary": {
+            "Total Orders": order_count,
+            "Total Sales": round(total_sales, 2),
+            "Average Basket": round(total_sales / order_count, 2) if order_count else 0,
+            "Average Items per Order": round(sold_qty / order_count, 2) if order_count else 0,
+        },
+        "by_channel": by_channel,
+        "by_hour": by_hour,
+        "by_weekday": by_weekday,
+        "per_sku": per_sku,
+        "top_customers": top_customers,
+    }
+
+# ---------- Customer Search ----------
+@st.cache_resource(show_spinner=False)
+def get_customer_search_index(storage_key: str):
+    """One index per storage per process, shared by all sessions."""
+    return CustomerSearchIndex()
+
+def search_customers(query):
+    """Best matching Customers rows for a name or phone query."""
+    index = get_customer_search_index(storage.key)
+    # Frame and version taken together: an index labelled with one version but built from another would stick
+    df, version = get_sheet_cache().typed_at(storage, "Customers")
+    index.sync(version, df)
+    return df.iloc[index.search(query)]
+
 # ---------- App ----------
 st.title("🛒 Yalla Shopping")
-st.caption("واجهة تعمل من اللابتوب والموبايل. قاعدة بيانات: Google Sheets.")
+st.caption("واجهة تعمل من اللابتوب والموبايل. قاعدة بيانات: " + ("SQLite محلية." if load_storage_backend() == "sqlite" else "Google Sheets."))
 
-# Load credentials (supporting multiple secret formats)
-sa_info = load_service_account_credentials()
-if sa_info is None:
-    st.error("فشل في تحميل بيانات Service Account")
-    st.stop()
+# Every rerun starts at normal API priority; the page may lower it below
+get_rate_limiter().set_priority(PRIORITY_NORMAL)
 
-client = get_gspread_client(sa_info)
+if load_storage_backend() == "sqlite":
+    # Local database: no Google credentials needed
+    try:
+        storage = get_sqlite_storage(load_sqlite_path())
+    except Exception as e:
+        st.error(f"خطأ في فتح قاعدة البيانات المحلية: {str(e)}")
+        st.stop()
+else:
+    # Load credentials (supporting multiple secret formats)
+    sa_info = load_service_account_credentials()
+    if sa_info is None:
+        st.error("فشل في تحميل بيانات Service Account")
+        st.stop()
 
-# Load Spreadsheet ID from secrets or environment
-spreadsheet_id = load_spreadsheet_id()
-if not spreadsheet_id:
-    st.error("يجب إضافة SPREADSHEET_ID داخل secrets أو كمتغير بيئة. راجع الخطوات في README_AR.md.")
-    st.stop()
+    client = get_gspread_client(sa_info)
+
+    # Load Spreadsheet ID from secrets or environment
+    spreadsheet_id = load_spreadsheet_id()
+    if not spreadsheet_id:
+        st.error("يجب إضافة SPREADSHEET_ID داخل secrets أو كمتغير بيئة. راجع الخطوات في README_AR.md.")
+        st.stop()
+
+    try:
+        sh = get_spreadsheet(client, spreadsheet_id)
+    except Exception as e:
+        st.error(f"خطأ في فتح جدول البيانات: {str(e)}")
+        st.error("تأكد من صحة SPREADSHEET_ID وأن Service Account له صلاحية الوصول للجدول.")
+        st.stop()
+
+    # The header checks are taken here on the script thread; the outbox thread must not call st.cache_resource
+    storage = SheetsStorage(sh, get_rate_limiter(), get_validated_worksheets())
+
+ws_map = storage
 
 try:
-    sh = client.open_by_key(spreadsheet_id)
+    outbox = get_outbox(load_outbox_path())
+    outbox.storage = storage
+    outbox.cache = get_sheet_cache()
+    outbox.limiter = get_rate_limiter()
+    outbox.coalescer = get_write_coalescer()
 except Exception as e:
-    st.error(f"خطأ في فتح جدول البيانات: {str(e)}")
-    st.error("تأكد من صحة SPREADSHEET_ID وأن Service Account له صلاحية الوصول للجدول.")
+    st.error(f"خطأ في فتح قائمة انتظار الطلبات: {str(e)}")
     st.stop()
 
-class LazyWs:
-    def __init__(self, sh):
-        self.sh = sh
-        self._cache = {}
-    def __getitem__(self, name: str):
-        if name in self._cache:
-            return self._cache[name]
-        ws = ensure_worksheet(self.sh, name)
-        self._cache[name] = ws
-        return ws
-
-ws_map = LazyWs(sh)
-
 try:
-    settings_ws = ws_map["Settings"]
-    settings_df = read_df(settings_ws, SCHEMAS["Settings"])
-    biz_name = get_setting(settings_df, "BusinessName", "Yalla Shopping")
-    biz_phone = get_setting(settings_df, "BusinessPhone", "")
-    biz_addr  = get_setting(settings_df, "BusinessAddress", "")
-    logo_b64  = get_setting(settings_df, "BusinessLogoB64", "")
+    # Cached for the whole process; saving settings writes through to the cache
+    settings = load_settings()
+    biz_name = settings.get("BusinessName", "Yalla Shopping")
+    biz_phone = settings.get("BusinessPhone", "")
+    biz_addr  = settings.get("BusinessAddress", "")
+    logo_digest = resolve_logo(settings)
 except Exception as e:
     st.error(f"خطأ في تحميل الإعدادات: {str(e)}")
     # Use default values if settings can't be loaded
+    settings = {}
     biz_name = "Yalla Shopping"
     biz_phone = ""
     biz_addr = ""
-    logo_b64 = ""
+    logo_digest = ""
 
 # Add system status and logout in sidebar
 with st.sidebar:
     # Show API usage status
-    if "api_calls_count" in st.session_state:
-        usage_color = "🟢" if st.session_state.api_calls_count < 30 else "🟡" if st.session_state.api_calls_count < 50 else "🔴"
-        st.caption(f"{usage_color} API Usage: {st.session_state.api_calls_count}/60 per minute")
+    if storage.kind == "sheets":
+        api_calls = get_rate_limiter().used_last_minute()
+        usage_color = "🟢" if api_calls < 30 else "🟡" if api_calls < 50 else "🔴"
+        st.caption(f"{usage_color} API Usage: {api_calls}/{API_REQUESTS_PER_MINUTE} per minute")
+        if client.metrics["retries"] or client.metrics["give_ups"]:
+            st.caption(f"🔁 إعادة محاولات API: {client.metrics['retries']} (فشل نهائي: {client.metrics['give_ups']})")
     
+    # Show write-behind outbox status
+    pending, oldest = outbox.stats()
+    if pending:
+        st.caption(f"📤 طلبات بانتظار المزامنة: {pending} (أقدمها منذ {int(time.time() - oldest)} ث)")
+        if outbox.last_error:
+            st.caption(f"⚠️ آخر خطأ مزامنة: {outbox.last_error[:120]}")
+    else:
+        st.caption("✅ كل الطلبات متزامنة")
+
+    # Show sheet cache memory use and hit rates
+    with st.expander("🗄️ الذاكرة المؤقتة", expanded=False):
+        cache_rows, cache_bytes = get_sheet_cache().stats(storage.key)
+        st.caption(f"المستخدم: {cache_bytes / 1024 / 1024:.1f} / {get_sheet_cache().max_bytes / 1024 / 1024:.1f} MB")
+        if cache_rows:
+            cache_stats = pd.DataFrame(cache_rows)
+            cache_stats["KB"] = (cache_stats.pop("bytes") / 1024).round(1)
+            st.dataframe(cache_stats, hide_index=True, use_container_width=True)
+
     # Logout button
     if st.button("🚪 تسجيل الخروج", type="secondary"):
         st.session_state["password_correct"] = False
@@ -721,8 +1073,11 @@ with st.sidebar:
         st.write("**حالة النظام:**")
         try:
             check_api_quota()
+            # Re-check every header from scratch
+            if storage.kind == "sheets":
+                storage.forget_checks()
             # Check all required worksheets with minimal API calls
-            required_sheets = ["Products", "Customers", "Orders", "OrderItems", "StockMovements", "Settings"]
+            required_sheets = ["Products", "Customers", "Orders", "OrderItems", "StockMovements", "Settings", "Assets", "DailySales"]
             for sheet_name in required_sheets:
                 try:
                     ws = ws_map[sheet_name]
@@ -733,13 +1088,15 @@ with st.sidebar:
                         st.error("🚫 تم تجاوز حد API - توقف الفحص")
                         break
                     st.error(f"❌ {sheet_name}: {str(e)}")
+            # Repaired sheets must be read again
+            get_sheet_cache().invalidate(storage.key, required_sheets)
         except Exception as e:
             st.error(f"خطأ في فحص النظام: {str(e)}")
     
     # Clear cache button
     if st.button("🗑️ مسح الذاكرة المؤقتة"):
         st.cache_data.clear()
-        st.cache_resource.clear()
+        get_sheet_cache().clear()
         st.success("تم مسح الذاكرة المؤقتة")
         st.info("أعد تحميل الصفحة لتحديث البيانات")
 
@@ -753,6 +1110,20 @@ page = st.sidebar.radio("القائمة", [
     "⚙️ الإعدادات",
 ])
 
+# Sheets each page reads, fetched together in one request before the page renders
+PAGE_SHEETS = {
+    "📊 لوحة المعلومات": ["Products", "Orders", "DailySales"],
+    "🧾 بيع جديد (POS)": ["Products", "Customers"],
+    "📦 المنتجات": ["Products"],
+    "👤 العملاء": ["Customers", "Orders", "OrderItems"],
+    "📥 حركة المخزون": ["Products", "StockMovements"],
+    "📈 التقارير": ["Orders", "OrderItems", "Products"],
+    "⚙️ الإعدادات": ["Settings"],
+}
+# Dashboards and reports yield the API budget to the POS and data entry pages
+get_rate_limiter().set_priority(PRIORITY_LOW if page in ("📊 لوحة المعلومات", "📈 التقارير") else PRIORITY_NORMAL)
+preload_sheets(PAGE_SHEETS.get(page, []))
+
 # -------- Dashboard --------
 if page == "📊 لوحة المعلومات":
     try:
@@ -762,6 +1133,9 @@ if page == "📊 لوحة المعلومات":
         with st.spinner("تحميل البيانات..."):
             products = read_df(ws_map["Products"], SCHEMAS["Products"], "Products")
             orders = read_df(ws_map["Orders"], SCHEMAS["Orders"], "Orders")
+            if not settings.get(DAILY_SALES_BUILT_KEY):
+                rebuild_daily_sales()
+            daily_sales = read_df(ws_map["DailySales"], SCHEMAS["DailySales"], "DailySales")
             
     except Exception as e:
         if "quota" in str(e).lower() or "rate_limit" in str(e).lower():
@@ -777,16 +1151,15 @@ if page == "📊 لوحة المعلومات":
 
     col1, col2, col3, col4 = st.columns(4)
     col1.metric("إجمالي المنتجات", len(products))
-    today_str = datetime.now(TZ).strftime("%Y-%m-%d")
-    today_orders = orders[orders["DateTime"].astype(str).str.startswith(today_str)]
-    col2.metric("طلبات اليوم", len(today_orders))
-    sales_today = today_orders["Total"].astype(float).sum() if not today_orders.empty else 0
-    col3.metric("مبيعات اليوم", f"{sales_today:.2f}")
+    # Today's rows of the DailySales rollup (one per channel) instead of scanning every order
+    today_sales = daily_sales[daily_sales["Date"] == datetime.now(TZ).strftime("%Y-%m-%d")]
+    col2.metric("طلبات اليوم", int(today_sales["Orders"].sum()))
+    col3.metric("مبيعات اليوم", f"{today_sales['Total'].sum():.2f}")
     low_stock = products[(products["Active"]!="No") & (products["InStock"].astype(float) <= products["LowStockThreshold"].astype(float))]
     col4.metric("نواقص/قرب النفاذ", len(low_stock))
 
-    if logo_b64:
-        st.image(f"data:image/png;base64,{logo_b64}", caption=biz_name, use_column_width=False)
+    if logo_digest:
+        st.image(asset_uri(logo_digest, "header"), caption=biz_name, use_column_width=False)
 
     st.subheader("تنبيهات المخزون المنخفض")
     if low_stock.empty:
@@ -797,14 +1170,8 @@ if page == "📊 لوحة المعلومات":
     st.subheader("آخر 10 طلبات")
     if not orders.empty and "DateTime" in orders.columns:
         try:
-            # Ensure DateTime is string for sorting
-            orders_sorted = orders.copy()
-            orders_sorted["DateTime"] = orders_sorted["DateTime"].astype(str)
-            # Check if DataFrame is not empty and has the column
-            if not orders_sorted.empty and "DateTime" in orders_sorted.columns:
-                st.dataframe(orders_sorted.sort_values(by="DateTime", ascending=False).head(10))
-            else:
-                st.dataframe(orders.head(10))
+            # DateTime is a typed datetime column; nlargest picks the newest without sorting everything
+            st.dataframe(orders.nlargest(10, "DateTime"))
         except Exception as e:
             st.warning(f"خطأ في ترتيب الطلبات: {str(e)}")
             st.dataframe(orders.head(10))
@@ -826,8 +1193,8 @@ elif page == "🧾 بيع جديد (POS)":
         st.error("تأكد من وجود أوراق Products و Customers في جدول البيانات.")
         if st.button("إعادة تهيئة أوراق البيانات"):
             try:
-                ensure_worksheet(sh, "Products")
-                ensure_worksheet(sh, "Customers")
+                storage.ensure("Products")
+                storage.ensure("Customers")
                 st.success("تم إعادة تهيئة أوراق البيانات. يرجى إعادة تحميل الصفحة.")
             except Exception as e2:
                 st.error(f"فشل في إعادة التهيئة: {str(e2)}")
@@ -863,11 +1230,11 @@ elif page == "🧾 بيع جديد (POS)":
         with c2:
             only_instock = st.checkbox("عرض المتاح فقط", value=False)
 
-    filtered = products.copy()
+    filtered = products
     if query.strip():
         q = query.strip()
         mask = (
-            filtered["Name"].astype(str).str.contains(q, case=False, na=False) |
+            filtered["Name"].str.contains(q, case=False, na=False) |
             filtered["SKU"].astype(str).str.contains(q, case=False, na=False)
         )
         filtered = filtered[mask]
@@ -875,7 +1242,7 @@ elif page == "🧾 بيع جديد (POS)":
         filtered = filtered[filtered["InStock"].astype(float) > 0]
 
     show_cols = ["SKU","Name","RetailPrice","InStock"]
-    edit_df = filtered[show_cols].copy()
+    edit_df = filtered[show_cols]
     edit_df["Qty"] = 0
     edit_df = st.data_editor(edit_df, num_rows="dynamic", use_container_width=True, key="pos_table")
 
@@ -938,68 +1305,58 @@ elif page == "🧾 بيع جديد (POS)":
     notes  = st.text_area("ملاحظات الطلب", "")
 
     if st.button("✅ تأكيد الطلب وخصم المخزون", use_container_width=True, type="primary", disabled=selected.empty or not cust_name):
+        new_cust = None
         if mode == "عميل جديد" or customers.empty:
             cust_id = "CUST" + datetime.now(TZ).strftime("%Y%m%d%H%M%S")
             new_cust = pd.DataFrame([[cust_id,cust_name,cust_phone,cust_address,cust_notes]], columns=SCHEMAS["Customers"])
-            ws = ws_map["Customers"]
-            existing = read_df(ws, SCHEMAS["Customers"], "Customers")
-            updated = pd.concat([existing, new_cust], ignore_index=True)
-            write_df(ws, updated)
 
         stock_ok = True
-        prod_df = read_df(ws_map["Products"], SCHEMAS["Products"], "Products").set_index("SKU")
+        prod_df = read_df(ws_map["Products"], SCHEMAS["Products"], "Products")
+        # SKU -> row position in the Products sheet (first match wins)
+        prod_pos = {}
+        for pos, sku in enumerate(prod_df["SKU"]):
+            prod_pos.setdefault(sku, pos)
+        # Orders still in the outbox have not reached the Products sheet yet
+        pending_deltas = outbox.pending_stock_deltas()
         for _, r in selected.iterrows():
             sku = str(r["SKU"]); need = int(float(str(r["Qty"])))
-            available = int(float(str(prod_df.loc[sku, "InStock"]))) if sku in prod_df.index else 0
+            available = int(prod_df["InStock"].iloc[prod_pos[sku]]) + pending_deltas.get(sku, 0) if sku in prod_pos else 0
             if need > available:
                 stock_ok = False
                 st.error(f"المخزون غير كافٍ للمنتج {sku} — المتاح {available} والطلب {need}")
         if stock_ok:
-            # Validate required worksheets
-            validate_worksheet_data("Orders")
-            validate_worksheet_data("OrderItems")
-            validate_worksheet_data("StockMovements")
-            
             order_id = gen_id("ORD")
-            now = datetime.now(TZ).strftime("%Y-%m-%d %H:%M:%S")
+            now = datetime.now(TZ).strftime(DATETIME_FORMAT)
             order_row = pd.Series({
                 "OrderID": order_id, "DateTime": now, "CustomerID": cust_id, "CustomerName": cust_name,
                 "CustomerAddress": cust_address, "Channel": channel, "Subtotal": float(subtotal),
                 "Discount": float(discount), "Delivery": float(delivery), "Deposit": float(deposit), "Total": float(total),
                 "Status": status, "Notes": notes
             })
-            orders_ws = ws_map["Orders"]
-            orders_df = read_df(orders_ws, SCHEMAS["Orders"], "Orders")
-            orders_df = pd.concat([orders_df, pd.DataFrame([order_row])], ignore_index=True)
-            write_df(orders_ws, orders_df)
 
-            items_ws = ws_map["OrderItems"]
-            items_df = read_df(items_ws, SCHEMAS["OrderItems"], "OrderItems")
             new_items = []
-            for _, r in selected.iterrows():
-                new_items.append([order_id, str(r["SKU"]), str(r["Name"]), int(float(str(r["Qty"]))), float(str(r["UnitPrice"])), float(str(r["LineTotal"]))])
-            add_items_df = pd.DataFrame(new_items, columns=SCHEMAS["OrderItems"])
-            items_df = pd.concat([items_df, add_items_df], ignore_index=True)
-            write_df(items_ws, items_df)
-
-            stock_ws = ws_map["StockMovements"]
-            stock_mov = read_df(stock_ws, SCHEMAS["StockMovements"], "StockMovements")
-            prod_df = read_df(ws_map["Products"], SCHEMAS["Products"], "Products").set_index("SKU")
-
+            new_movements = []
+            stock_deltas = {}
             for _, r in selected.iterrows():
                 sku = str(r["SKU"]); qty = int(float(str(r["Qty"])))
-                if sku in prod_df.index:
-                    current = int(float(str(prod_df.loc[sku,"InStock"])))
-                    prod_df.loc[sku,"InStock"] = current - qty
-                stock_mov = pd.concat([stock_mov, pd.DataFrame([[now, sku, -qty, "Sale", order_id, ""]], columns=SCHEMAS["StockMovements"])], ignore_index=True)
+                new_items.append([order_id, sku, str(r["Name"]), qty, float(str(r["UnitPrice"])), float(str(r["LineTotal"]))])
+                new_movements.append([now, sku, -qty, "Sale", order_id, ""])
+                if sku in prod_pos:
+                    stock_deltas[sku] = stock_deltas.get(sku, 0) - qty
+            add_items_df = pd.DataFrame(new_items, columns=SCHEMAS["OrderItems"])
 
-            write_df(ws_map["Products"], prod_df.reset_index())
-            write_df(stock_ws, stock_mov)
+            # Customer, order, items, movements and stock as one queued transaction
+            commit_checkout(order_id, {
+                "Customers": new_cust,
+                "Orders": pd.DataFrame([order_row]),
+                "OrderItems": add_items_df,
+                "StockMovements": pd.DataFrame(new_movements, columns=SCHEMAS["StockMovements"]),
+            }, stock_deltas)
 
             st.success(f"تم إنشاء الطلب {order_id} وتحديث المخزون ✅")
             # Use the file system logo if available, otherwise use uploaded logo
-            invoice_logo = load_logo() or logo_b64
-            invoice = invoice_html(order_row, add_items_df, business_name=biz_name, business_phone=biz_phone, business_addr=biz_addr, logo_b64=invoice_logo)
+            invoice_logo = asset_uri(load_logo(), "invoice") or asset_uri(logo_digest, "invoice")
+            invoice = invoice_html(order_row, add_items_df, business_name=biz_name, business_phone=biz_phone, business_addr=biz_addr, logo_src=invoice_logo)
             st.download_button("🧾 تحميل الفاتورة (HTML للطباعة)", data=invoice.encode("utf-8"), file_name=f"invoice_{order_id}.html", mime="text/html", use_container_width=True)
 
 # -------- Products --------
@@ -1029,7 +1386,8 @@ elif page == "📦 المنتجات":
                 idx = df.index[exists][0]
                 df.loc[idx, ["Name","RetailPrice","InStock","LowStockThreshold","Active","Notes"]] = [name, retail, instock, lowthr, active, notes]
             else:
-                df = pd.concat([df, pd.DataFrame([[sku,name,retail,instock,lowthr,active,notes]], columns=SCHEMAS["Products"])], ignore_index=True)
+                # Grown in place: a concat would drop the version read_df stamped on the frame
+                df.loc[len(df)] = [sku, name, retail, instock, lowthr, active, notes]
             write_df(ws, df)
             st.success("تم الحفظ ✅")
         else:
@@ -1070,7 +1428,7 @@ elif page == "👤 العملاء":
                 idx = df.index[exists][0]
                 df.loc[idx, ["Name","Phone","Address","Notes"]] = [name, phone, address, notes]
             else:
-                df = pd.concat([df, pd.DataFrame([[cust_id,name,phone,address,notes]], columns=SCHEMAS["Customers"])], ignore_index=True)
+                df.loc[len(df)] = [cust_id, name, phone, address, notes]
             write_df(ws, df)
             st.success("تم الحفظ ✅")
 
@@ -1086,10 +1444,10 @@ elif page == "👤 العملاء":
     search_query = st.text_input("ابحث بالاسم أو رقم الموبايل", placeholder="اكتب اسم العميل أو رقم الموبايل...")
     
     if search_query:
-        # Search in customers
-        name_mask = df["Name"].astype(str).str.contains(search_query, case=False, na=False)
-        phone_mask = df["Phone"].astype(str).str.contains(search_query, case=False, na=False)
-        search_results = df[name_mask | phone_mask]
+        validate_worksheet_data("Orders")
+        validate_worksheet_data("OrderItems")
+        # Ranked matches from the prebuilt index (Arabic letter variants and phone formats fold together)
+        search_results = search_customers(search_query)
         
         if not search_results.empty:
             st.success(f"تم العثور على {len(search_results)} عميل")
@@ -1106,10 +1464,7 @@ elif page == "👤 العملاء":
                     with col2:
                         # Get customer orders
                         try:
-                            validate_worksheet_data("Orders")
-                            validate_worksheet_data("OrderItems")
-                            orders = read_df(ws_map["Orders"], SCHEMAS["Orders"], "Orders")
-                            customer_orders = orders[orders["CustomerID"] == customer["CustomerID"]]
+                            customer_orders = orders_for_customer(str(customer["CustomerID"]))
                         except Exception as e:
                             st.error(f"خطأ في تحميل طلبات العميل: {str(e)}")
                             customer_orders = pd.DataFrame()
@@ -1121,10 +1476,9 @@ elif page == "👤 العملاء":
                             # Show order details
                             st.write("**تفاصيل الطلبات:**")
                             for _, order in customer_orders.iterrows():
-                                order_items = read_df(ws_map["OrderItems"], SCHEMAS["OrderItems"], "OrderItems")
-                                order_products = order_items[order_items["OrderID"] == order["OrderID"]]
+                                order_products = items_for_orders([order["OrderID"]])
                                 
-                                st.write(f"📋 **طلب {order['OrderID']}** - {order['DateTime']}")
+                                st.write(f"📋 **طلب {order['OrderID']}** - {order['DateTime'].strftime(DATETIME_FORMAT) if pd.notna(order['DateTime']) else ''}")
                                 st.write(f"   الحالة: {order['Status']} | القناة: {order['Channel']}")
                                 st.write(f"   الإجمالي: {order['Total']} | الخصم: {order['Discount']} | التوصيل: {order['Delivery']} | العربون: {order['Deposit']}")
                                 
@@ -1168,16 +1522,13 @@ elif page == "📥 حركة المخزون":
     if st.button("➕ إضافة الحركة وتحديث المخزون", type="primary"):
         if sku and change != 0:
             sku_only = str(sku).split(" — ")[0]
-            now = datetime.now(TZ).strftime("%Y-%m-%d %H:%M:%S")
-            movements = pd.concat([movements, pd.DataFrame([[now, sku_only, int(change), reason, "", note]], columns=SCHEMAS["StockMovements"])], ignore_index=True)
-            write_df(ws_mov, movements)
-            products_copy = products.copy()
-            products_copy.set_index("SKU", inplace=True)
-            if sku_only in products_copy.index:
-                current = int(float(str(products_copy.loc[sku_only,"InStock"])))
-                products_copy.loc[sku_only,"InStock"] = current + int(change)
-                products_copy = products_copy.reset_index()
-                write_df(ws_prod, products_copy)
+            now = datetime.now(TZ).strftime(DATETIME_FORMAT)
+            new_movement = pd.DataFrame([[now, sku_only, int(change), reason, "", note]], columns=SCHEMAS["StockMovements"])
+            # Movement and stock change in one transaction, applied to the current stock
+            known_sku = sku_only in set(products["SKU"].astype(str))
+            commit_stock_change({"StockMovements": new_movement}, {sku_only: int(change)} if known_sku else {})
+            movements = pd.concat([movements, _type_frame("StockMovements", new_movement)], ignore_index=True)
+            if known_sku:
                 st.success("تم تحديث المخزون ✅")
         else:
             st.error("يرجى اختيار منتج وتحديد كمية صحيحة")
@@ -1186,14 +1537,8 @@ elif page == "📥 حركة المخزون":
     st.subheader("سجل الحركات")
     if not movements.empty and "Timestamp" in movements.columns:
         try:
-            # Ensure Timestamp is string for sorting
-            movements_sorted = movements.copy()
-            movements_sorted["Timestamp"] = movements_sorted["Timestamp"].astype(str)
-            # Check if DataFrame is not empty and has the column
-            if not movements_sorted.empty and "Timestamp" in movements_sorted.columns:
-                st.dataframe(movements_sorted.sort_values(by="Timestamp", ascending=False), use_container_width=True)
-            else:
-                st.dataframe(movements, use_container_width=True)
+            # Timestamp is a typed datetime column, so it sorts chronologically as is
+            st.dataframe(movements.sort_values(by="Timestamp", ascending=False), use_container_width=True)
         except Exception as e:
             st.warning(f"خطأ في ترتيب الحركات: {str(e)}")
             st.dataframe(movements, use_container_width=True)
@@ -1207,7 +1552,6 @@ elif page == "📈 التقارير":
     validate_worksheet_data("Products")
     
     orders = read_df(ws_map["Orders"], SCHEMAS["Orders"], "Orders")
-    items  = read_df(ws_map["OrderItems"], SCHEMAS["OrderItems"], "OrderItems")
     products = read_df(ws_map["Products"], SCHEMAS["Products"], "Products")
 
     st.markdown("### تقرير فترة")
@@ -1218,24 +1562,44 @@ elif page == "📈 التقارير":
     with c2:
         end   = st.date_input("إلى", date.today())
 
+    if not orders.empty:
+        report = sales_report(start, end)
+        summary = report["summary"]
+        m1, m2, m3, m4 = st.columns(4)
+        m1.metric("عدد الطلبات", summary["Total Orders"])
+        m2.metric("إجمالي المبيعات", f"{summary['Total Sales']:.2f}")
+        m3.metric("متوسط قيمة الطلب", f"{summary['Average Basket']:.2f}")
+        m4.metric("متوسط القطع بالطلب", summary["Average Items per Order"])
+
+        tab_channel, tab_hour, tab_weekday, tab_sku, tab_customers = st.tabs(
+            ["حسب القناة", "حسب الساعة", "حسب اليوم", "إيراد المنتجات", "أفضل العملاء"]
+        )
+        with tab_channel:
+            st.dataframe(report["by_channel"], hide_index=True)
+        with tab_hour:
+            st.bar_chart(report["by_hour"].set_index("Hour")["Total"])
+            st.dataframe(report["by_hour"], hide_index=True)
+        with tab_weekday:
+            st.dataframe(report["by_weekday"], hide_index=True)
+        with tab_sku:
+            st.dataframe(report["per_sku"], hide_index=True)
+        with tab_customers:
+            st.dataframe(report["top_customers"], hide_index=True)
+
     if st.button("📤 استخراج التقرير (CSV)"):
         if not orders.empty:
-            mask = orders["DateTime"].apply(lambda x: x[:10] >= str(start) and x[:10] <= str(end))
-            sel_orders = orders[mask].copy()
-            total_sales = sel_orders["Total"].astype(float).sum()
-
-            sel_items = items[items["OrderID"].isin(sel_orders["OrderID"])]
-            agg = sel_items.groupby(["SKU","Name"])["Qty"].sum().reset_index().rename(columns={"Qty":"SoldQty"})
-
             low_stock = products[(products["Active"]!="No") & (products["InStock"].astype(float) <= products["LowStockThreshold"].astype(float))]
 
             out = io.StringIO()
             out.write("=== Sales Summary ===\n")
             out.write(f"From,{start},To,{end}\n")
-            out.write(f"Total Orders,{len(sel_orders)}\n")
-            out.write(f"Total Sales,{total_sales:.2f}\n\n")
-            out.write("=== Top Sold Items ===\n")
-            agg.to_csv(out, index=False)
+            for label, value in report["summary"].items():
+                out.write(f"{label},{value}\n")
+            sections = [("Sales by Channel", "by_channel"), ("Sales by Hour", "by_hour"), ("Sales by Weekday", "by_weekday"),
+                        ("Revenue per SKU", "per_sku"), ("Top Customers", "top_customers")]
+            for title, key in sections:
+                out.write(f"\n=== {title} ===\n")
+                report[key].to_csv(out, index=False)
             out.write("\n=== Low Stock (at export time) ===\n")
             low_stock.to_csv(out, index=False)
             st.download_button("تنزيل التقرير CSV", out.getvalue(), file_name=f"report_{start}_to_{end}.csv", mime="text/csv")
@@ -1262,20 +1626,18 @@ elif page == "⚙️ الإعدادات":
         new_biz_addr = st.text_area("العنوان", value=biz_addr)
 
     logo_file = st.file_uploader("شعار المتجر (اختياري)", type=["png","jpg","jpeg"])
-    logo_b64_new = logo_b64
     if logo_file is not None:
-        logo_b64_new = base64.b64encode(logo_file.read()).decode("utf-8")
         st.image(logo_file, caption="معاينة الشعار", use_column_width=False)
         st.success("✅ تم تحميل الشعار بنجاح! سيظهر في الفواتير.")
     
     # Show current logo - check both uploaded and file system logos
-    current_logo_b64 = load_logo()
-    if current_logo_b64 or logo_b64:
+    current_logo = load_logo()
+    if current_logo or logo_digest:
         st.markdown("**الشعار الحالي:**")
-        display_logo = logo_b64 if logo_b64 else current_logo_b64
-        st.image(f"data:image/png;base64,{display_logo}", caption="الشعار المستخدم حالياً", width=150)
+        display_logo = logo_digest if logo_digest else current_logo
+        st.image(asset_uri(display_logo, "thumb"), caption="الشعار المستخدم حالياً", width=150)
         
-        if current_logo_b64 and not logo_b64:
+        if current_logo and not logo_digest:
             st.success("✅ يتم استخدام الشعار من ملف assets/logo_yalla_shopping.png")
     else:
         st.info("ℹ️ لا يوجد شعار محدد حالياً. سيظهر النص الافتراضي '🛒 Yalla Shopping' في الفواتير.")
@@ -1289,11 +1651,17 @@ elif page == "⚙️ الإعدادات":
             if (df["Key"]==k).any():
                 df.loc[df["Key"]==k, "Value"] = v
             else:
-                df = pd.concat([df, pd.DataFrame([[k,v]], columns=SCHEMAS["Settings"])], ignore_index=True)
+                df.loc[len(df)] = [k, v]
             return df
         s = upsert(s, "BusinessName", new_biz_name)
         s = upsert(s, "BusinessPhone", new_biz_phone)
         s = upsert(s, "BusinessAddress", new_biz_addr)
-        s = upsert(s, "BusinessLogoB64", logo_b64_new)
+        # Settings keep only the logo's hash; the image itself goes to the Assets sheet once
+        if logo_file is not None:
+            s = upsert(s, "BusinessLogo", save_asset(logo_file.getvalue()))
+        elif logo_digest and not settings.get("BusinessLogo"):
+            s = upsert(s, "BusinessLogo", save_asset(get_asset_store().originals[logo_digest]))
+        if (s["Key"] == "BusinessLogoB64").any():
+            s = upsert(s, "BusinessLogoB64", "")
         write_df(settings_ws, s)
         st.success("تم الحفظ ✅")
\ No newline at end of file
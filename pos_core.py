@@ -0,0 +1,1970 @@
+"""Storage engine of the Yalla Shopping POS.
+
+Schemas, the storage backends, the write-behind outbox and write coalescer,
+the shared sheet cache, the report cube and customer search. Nothing here
+imports Streamlit: the outbox, coalescer and snapshot threads run this code
+outside any script run, where st.* calls do nothing or raise. app.py creates
+the shared instances (st.cache_resource) and shows the errors raised here.
+"""
+import time, random, json, os, sys, logging, atexit
+import sqlite3, threading, collections, contextlib, itertools, hashlib, re, bisect
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+import gspread
+import numpy as np
+import pandas as pd
+import pytz
+import requests
+
+# Frames handed out by the shared cache are shallow; copy-on-write keeps each session's edits private
+pd.set_option("mode.copy_on_write", True)
+
+TZ = pytz.timezone("Africa/Cairo")
+
+logger = logging.getLogger(__name__)
+
+# ---------- Schemas ----------
+SCHEMAS = {
+    "Products": ["SKU","Name","RetailPrice","InStock","LowStockThreshold","Active","Notes"],
+    "Customers": ["CustomerID","Name","Phone","Address","Notes"],
+    "Orders": ["OrderID","DateTime","CustomerID","CustomerName","CustomerAddress","Channel","Subtotal","Discount","Delivery","Deposit","Total","Status","Notes"],
+    "OrderItems": ["OrderID","SKU","Name","Qty","UnitPrice","LineTotal"],
+    "StockMovements": ["Timestamp","SKU","Change","Reason","Reference","Note"],
+    "Settings": ["Key","Value"],
+    "Assets": ["Hash","Part","Data"],
+    "DailySales": ["Date","Channel","Orders","Gross","Discount","Delivery","Deposit","Total"]
+}
+
+# Column types per sheet, applied once per cached version; unlisted columns stay text.
+# Low-cardinality labels are categories, times are Cairo datetimes and free text is Arrow-backed.
+DTYPES = {
+    "Products": {"Name": "string[pyarrow]", "RetailPrice": "float64", "InStock": "int64", "LowStockThreshold": "int64",
+                 "Active": "category", "Notes": "string[pyarrow]"},
+    "Customers": {"Name": "string[pyarrow]", "Address": "string[pyarrow]", "Notes": "string[pyarrow]"},
+    "Orders": {"DateTime": "datetime64[ns, Africa/Cairo]", "CustomerName": "string[pyarrow]", "CustomerAddress": "string[pyarrow]",
+               "Channel": "category", "Subtotal": "float64", "Discount": "float64", "Delivery": "float64", "Deposit": "float64",
+               "Total": "float64", "Status": "category", "Notes": "string[pyarrow]"},
+    "OrderItems": {"Name": "string[pyarrow]", "Qty": "int64", "UnitPrice": "float64", "LineTotal": "float64"},
+    "StockMovements": {"Timestamp": "datetime64[ns, Africa/Cairo]", "Change": "int64", "Reason": "category",
+                       "Note": "string[pyarrow]"},
+    "DailySales": {"Channel": "category", "Orders": "int64", "Gross": "float64", "Discount": "float64",
+                   "Delivery": "float64", "Deposit": "float64", "Total": "float64"},
+}
+
+NUMERIC_COLS = [col for types in DTYPES.values() for col, dtype in types.items() if dtype in ("int64", "float64")]
+
+# Values the app itself writes are always categories, so setting them on a cached frame never fails
+CATEGORIES = {
+    "Active": ["Yes", "No"],
+    "Channel": ["Facebook Page", "Instagram", "Phone", "WhatsApp", "Other"],
+    "Status": ["Paid", "Pending", "Shipped", "Cancelled"],
+    "Reason": ["Purchase", "Adjustment", "ReturnIn", "ReturnOut", "Sale"],
+}
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Row keys of the mutable sheets; saves send only the cells that changed
+KEY_COLUMNS = {"Products": "SKU", "Customers": "CustomerID", "Settings": "Key"}
+
+# ---------- Quota Management ----------
+# Google Sheets allows 60 requests per minute for the service account, across all sessions
+API_REQUESTS_PER_MINUTE = 60
+# Request priorities: checkout writes first, page reads next, dashboard/report reads last
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW = 0, 1, 2
+# Tokens each priority must leave in the bucket for the priorities above it
+PRIORITY_RESERVE = {PRIORITY_HIGH: 0, PRIORITY_NORMAL: 5, PRIORITY_LOW: 15}
+
+class ApiBudgetExceeded(Exception):
+    """No API token became available in time."""
+
+class RateLimiter:
+    """Token bucket for Sheets API requests, shared by every session.
+
+    The bucket holds API_REQUESTS_PER_MINUTE tokens and refills continuously.
+    A request may only take a token while more than PRIORITY_RESERVE[priority]
+    tokens are left, so dashboards and reports back off long before checkout
+    writes run dry. The priority is set per thread.
+    """
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.cond = threading.Condition()
+        self.local = threading.local()
+        self.calls = collections.deque()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def current_priority(self):
+        return getattr(self.local, "priority", PRIORITY_NORMAL)
+
+    def set_priority(self, level):
+        self.local.priority = level
+
+    @contextlib.contextmanager
+    def priority(self, level):
+        previous = self.current_priority()
+        self.local.priority = level
+        try:
+            yield
+        finally:
+            self.local.priority = previous
+
+    def tight(self, level=None):
+        """True when a request at `level` (default: this thread's) would have to wait."""
+        level = self.current_priority() if level is None else level
+        with self.cond:
+            self._refill()
+            return self.tokens - 1 < PRIORITY_RESERVE[level]
+
+    def acquire(self, timeout=60):
+        level = self.current_priority()
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                self._refill()
+                if self.tokens - 1 >= PRIORITY_RESERVE[level]:
+                    self.tokens -= 1
+                    self.calls.append(time.time())
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ApiBudgetExceeded("Sheets API quota budget exhausted")
+                self.cond.wait(min((PRIORITY_RESERVE[level] + 1 - self.tokens) / self.rate, remaining))
+
+    def used_last_minute(self):
+        with self.cond:
+            while self.calls and time.time() - self.calls[0] > 60:
+                self.calls.popleft()
+            return len(self.calls)
+
+# ---------- Sheets Client ----------
+# Sheets errors worth retrying: rate limiting and transient server errors
+RETRY_STATUS = {429, 500, 502, 503, 504}
+API_RETRY_DEADLINE = 30  # seconds per request, waits and retries included
+API_RETRY_MAX_BACKOFF = 16
+
+class GuardedClient(gspread.Client):
+    """gspread client that sends every API request through the shared rate limiter.
+
+    Rate-limit (429) and server (5xx) errors are retried with capped
+    exponential backoff and full jitter, never sooner than Retry-After, until
+    API_RETRY_DEADLINE runs out. Writes are retried only on 429, when the API
+    refused them outright; a 5xx after a write may already have applied it.
+    """
+    limiter = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = {"retries": 0, "give_ups": 0}
+        self.metrics_lock = threading.Lock()
+
+    def _count(self, name):
+        with self.metrics_lock:
+            self.metrics[name] += 1
+
+    def _retry_delay(self, method, error, attempt):
+        """Seconds to wait before retrying, or None if the error must not be retried."""
+        retry_after = None
+        if isinstance(error, gspread.exceptions.APIError):
+            status = getattr(error.response, "status_code", None)
+            if status not in RETRY_STATUS or (status != 429 and method.lower() != "get"):
+                return None
+            headers = getattr(error.response, "headers", None) or {}
+            retry_after = headers.get("Retry-After")
+        elif not (isinstance(error, requests.exceptions.RequestException) and method.lower() == "get"):
+            return None
+        delay = random.uniform(0, min(API_RETRY_MAX_BACKOFF, 2 ** attempt))
+        try:
+            delay = max(delay, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+        return delay
+
+    def request(self, method, *args, **kwargs):
+        deadline = time.monotonic() + API_RETRY_DEADLINE
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire(timeout=max(1.0, deadline - time.monotonic()))
+            try:
+                return super().request(method, *args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(method, e, attempt)
+                if delay is None:
+                    raise
+                if time.monotonic() + delay > deadline:
+                    self._count("give_ups")
+                    raise
+                self._count("retries")
+                attempt += 1
+                time.sleep(delay)
+
+def forget_validated(sh_id, validated, names=None):
+    for key in list(validated):
+        if key[0] == sh_id and (names is None or key[1] in names):
+            validated.pop(key, None)
+
+def _headers_ok(first_row, expected_headers):
+    has_duplicates = len(first_row) != len(set(first_row)) and any(first_row)
+    headers_wrong = (len(first_row) < len(expected_headers) or 
+                   not all(first_row[i] == expected_headers[i] for i in range(min(len(first_row), len(expected_headers)))))
+    return not (has_duplicates or headers_wrong)
+
+def ensure_worksheet(sh, name, validated):
+    """The worksheet `name`, created or with its header repaired if needed.
+
+    `validated` is the process-wide {(spreadsheet id, name): worksheet} of
+    headers already checked. Runs on the outbox and coalescer threads too, so
+    failures are raised (or logged), never shown with st.*.
+    """
+    if (sh.id, name) in validated:
+        return validated[(sh.id, name)]
+    try:
+        ws = sh.worksheet(name)
+        # Verify the worksheet has proper headers (header row only; the full sheet is read just for repairs)
+        try:
+            expected_headers = SCHEMAS[name]
+            header = ws.get("A1:Z1")
+            if header and _headers_ok(header[0], expected_headers):
+                validated[(sh.id, name)] = ws
+                return ws
+            all_values = ws.get_all_values()
+            
+            if not all_values:
+                # Empty worksheet, add headers
+                ws.update(values=[expected_headers], range_name=f"A1:{chr(64+len(expected_headers))}1")
+            else:
+                if not _headers_ok(all_values[0], expected_headers):
+                    # Keep existing data but fix headers
+                    if len(all_values) > 1:
+                        data_rows = all_values[1:]
+                        ws.clear()
+                        ws.update(values=[expected_headers], range_name=f"A1:{chr(64+len(expected_headers))}1")
+                        if data_rows:
+                            # Ensure data fits schema
+                            formatted_data = []
+                            for row in data_rows:
+                                # Skip empty rows
+                                if any(cell.strip() for cell in row if cell):
+                                    formatted_row = row[:len(expected_headers)] + [''] * max(0, len(expected_headers) - len(row))
+                                    formatted_data.append(formatted_row)
+                            if formatted_data:
+                                end_col = chr(64 + len(expected_headers))
+                                end_row = len(formatted_data) + 1
+                                ws.update(values=formatted_data, range_name=f"A2:{end_col}{end_row}")
+                    else:
+                        ws.clear()
+                        ws.update(values=[expected_headers], range_name=f"A1:{chr(64+len(expected_headers))}1")
+            validated[(sh.id, name)] = ws
+                        
+        except Exception as e:
+            logger.warning("Could not repair the header of sheet %s: %s", name, e)
+            
+    except gspread.exceptions.WorksheetNotFound:
+        try:
+            ws = sh.add_worksheet(title=name, rows=1000, cols=30)
+            header = SCHEMAS[name]
+            ws.update(values=[header], range_name=f"A1:{chr(64+len(header))}1")
+            validated[(sh.id, name)] = ws
+        except Exception as e:
+            raise RuntimeError(f"خطأ في إنشاء ورقة {name}: {str(e)}") from e
+    return ws
+
+# ---------- Storage Backends ----------
+# Both backends expose the same small interface used by read_df/write_df/append_df:
+#   storage[name]                 -> worksheet-like handle with a `.title`
+#   read_values(name)             -> header + data rows as lists of strings
+#   read_tail(name, start)        -> (header, data rows from position `start` on)
+#   read_many({name: start})      -> {name: (header, rows)} for several sheets at once
+#   write_values(name, values)    -> replace the whole sheet (header included)
+#   read_column(name, col)        -> one column's data cells as strings
+#   commit(appends, cell_updates, stock_deltas=None)
+#                                 -> appends {name: rows}, cell updates [(name, row_pos, column, value)]
+#                                    and InStock changes {sku: delta} in one transaction; appended
+#                                    Orders rows also add to their DailySales counters there;
+#                                    returns the (appends, cell_updates) actually written
+#   rebuild_daily_sales()         -> recompute DailySales from all Orders and set DAILY_SALES_BUILT_KEY
+#                                    in one transaction with the counter writes; False if already built
+#   validate(name) / ensure(name) -> check / repair the sheet structure
+#   busy()                        -> True when low-priority reads should use cached data
+#   snapshots                     -> True when SheetCache should keep on-disk snapshots of this backend
+#   modified()                    -> token that changes whenever the data changes (snapshot backends only)
+
+# Hidden one-cell sheet whose sheet id is the revision of the counters (InStock and DailySales);
+# its only cell holds that id so it can be read with the counters. A counter write deletes it
+# by id and adds it back under a new id in the same batchUpdate. Sheets applies a batch
+# all-or-nothing and deleteSheet fails for an id that is already gone, so of two terminals
+# that read the same revision only the first one writes; the other reads again and retries.
+REVISION_SHEET = "CountersRevision"
+COUNTER_WRITE_ATTEMPTS = 5
+
+def _revision_conflict(error):
+    """True when a guarded batchUpdate was refused because the revision sheet had changed.
+
+    The swap is always the first requests of the batch: deleteSheet of a revision that is
+    gone, or addSheet of a revision sheet another terminal created first.
+    """
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    return status == 400 and re.search(r"requests\[[01]\]\.(deleteSheet|addSheet)", str(error)) is not None
+
+def _row_data(row):
+    """Wrap a list of cell strings as Sheets API RowData."""
+    return {"values": [{"userEnteredValue": {"stringValue": str(v)}} for v in row]}
+
+# DailySales counters and the Orders column each one sums ("Orders" counts rows)
+DAILY_SALES_SOURCES = [("Orders", None), ("Gross", "Subtotal"), ("Discount", "Discount"),
+                       ("Delivery", "Delivery"), ("Deposit", "Deposit"), ("Total", "Total")]
+DAILY_SALES_COUNTERS = [c for c, _ in DAILY_SALES_SOURCES]
+
+def _cell_number(value):
+    try:
+        return float(value or 0)
+    except ValueError:
+        return 0.0
+
+def _daily_sales_deltas(order_rows):
+    """Sum new Orders rows into {(date, channel): [counter deltas]} for DailySales."""
+    cols = SCHEMAS["Orders"]
+    deltas = {}
+    for row in order_rows:
+        row = _pad_row(row, len(cols))
+        key = (str(row[cols.index("DateTime")])[:10], str(row[cols.index("Channel")]))
+        totals = deltas.setdefault(key, [0.0] * len(DAILY_SALES_SOURCES))
+        for i, (_, source) in enumerate(DAILY_SALES_SOURCES):
+            totals[i] += 1 if source is None else _cell_number(row[cols.index(source)])
+    return deltas
+
+def _add_counters(current, delta):
+    """Counter cells after adding `delta` to `current`, formatted for storage."""
+    out = []
+    for col, value, change in zip(DAILY_SALES_COUNTERS, current, delta):
+        total = _cell_number(value) + change
+        out.append(str(int(round(total))) if col == "Orders" else str(round(total, 2)))
+    return out
+
+# Settings key set once DailySales holds the orders recorded before the rollup existed
+DAILY_SALES_BUILT_KEY = "DailySalesBuilt"
+
+def _daily_sales_rows(order_rows):
+    """The whole DailySales sheet for these Orders rows, sorted by date and channel."""
+    deltas = _daily_sales_deltas(order_rows)
+    return [list(key) + _add_counters([0] * len(delta), delta) for key, delta in sorted(deltas.items())]
+
+def _find_setting(rows, key):
+    """(position, value) of `key` in Settings data rows, or (None, "")."""
+    for pos, row in enumerate(rows):
+        if row and row[0] == key:
+            return pos, (row[1] if len(row) > 1 else "")
+    return None, ""
+
+class SheetsStorage:
+    """Google Sheets backend: one worksheet per schema."""
+    kind = "sheets"
+    snapshots = True
+
+    def __init__(self, sh, limiter=None, validated=None):
+        self.sh = sh
+        self.limiter = limiter
+        self.key = f"sheets:{sh.id}"
+        self._cache = {}
+        # The process-wide header checks (see ensure_worksheet), passed in by the script thread
+        self.validated = {} if validated is None else validated
+
+    def __getitem__(self, name: str):
+        if name in self._cache:
+            return self._cache[name]
+        ws = ensure_worksheet(self.sh, name, self.validated)
+        self._cache[name] = ws
+        return ws
+
+    def busy(self):
+        limiter = self.limiter
+        return limiter is not None and limiter.current_priority() == PRIORITY_LOW and limiter.tight()
+
+    def ensure(self, name):
+        # Repair: re-check the header even if it was validated before
+        self._cache.pop(name, None)
+        forget_validated(self.sh.id, self.validated, [name])
+        return self[name]
+
+    def forget_checks(self):
+        # Re-check every header from scratch on the next access
+        self._cache.clear()
+        forget_validated(self.sh.id, self.validated)
+
+    def read_values(self, name):
+        return self[name].get_all_values()
+
+    def read_tail(self, name, start):
+        return self.read_many({name: start})[name]
+
+    def read_many(self, starts):
+        # Header and the rows from data position `start` on for every sheet, in one values.batchGet
+        ranges = []
+        for name, start in starts.items():
+            self[name]
+            end_col = chr(64 + len(SCHEMAS[name]))
+            ranges += [f"'{name}'!A1:{end_col}1", f"'{name}'!A{start + 2}:{end_col}"]
+        value_ranges = self.sh.values_batch_get(ranges).get("valueRanges", [])
+        result = {}
+        for i, name in enumerate(starts):
+            header = value_ranges[2 * i].get("values", [])
+            rows = value_ranges[2 * i + 1].get("values", [])
+            result[name] = ((list(header[0]) if header else []), [list(r) for r in rows])
+        return result
+
+    def read_column(self, name, col):
+        return self[name].col_values(SCHEMAS[name].index(col) + 1)[1:]
+
+    def modified(self):
+        # Drive's modifiedTime changes on every edit, from this app or anyone else
+        return self.sh.get_lastUpdateTime()
+
+    def write_values(self, name, values):
+        ws = self[name]
+        ws.clear()
+        if values:
+            end_col = chr(64 + len(values[0]))
+            end_row = len(values)
+            ws.update(values=values, range_name=f"A1:{end_col}{end_row}")
+
+    def commit(self, appends, cell_updates, stock_deltas=None):
+        sales_deltas = _daily_sales_deltas(appends.get("Orders", []))
+        if stock_deltas or sales_deltas:
+            return self._commit_counters(appends, cell_updates, stock_deltas or {}, sales_deltas)
+        self._batch_update(appends, cell_updates)
+        return appends, cell_updates
+
+    def _batch_update(self, appends, cell_updates, guard=()):
+        # One spreadsheets.batchUpdate; the Sheets API applies it atomically (`guard` requests first)
+        requests = list(guard)
+        for name, rows in appends.items():
+            if rows:
+                requests.append({"appendCells": {
+                    "sheetId": self[name].id,
+                    "rows": [_row_data(r) for r in rows],
+                    "fields": "userEnteredValue",
+                }})
+        for name, pos, col, value in cell_updates:
+            requests.append({"updateCells": {
+                # +1 skips the header row
+                "start": {"sheetId": self[name].id, "rowIndex": pos + 1, "columnIndex": SCHEMAS[name].index(col)},
+                "rows": [_row_data([value])],
+                "fields": "userEnteredValue",
+            }})
+        if requests:
+            self.sh.batch_update({"requests": requests})
+
+    def _counter_state(self, with_stock, with_sales):
+        """(revision, {sku: (pos, InStock)}, {(date, channel): (pos, counters)}) in one request."""
+        stock_col = SCHEMAS["Products"].index("InStock")
+        ranges = []
+        if with_stock:
+            ranges.append(f"'Products'!A2:{chr(65 + stock_col)}")
+        if with_sales:
+            ranges.append(f"'DailySales'!A2:{chr(64 + len(SCHEMAS['DailySales']))}")
+        revision, value_ranges = self._read_guarded(ranges)
+        stock, sales = {}, {}
+        if with_stock:
+            for pos, row in enumerate(value_ranges[0].get("values", [])):
+                row = _pad_row(row, stock_col + 1)
+                if row[0] and row[0] not in stock:
+                    try:
+                        stock[row[0]] = (pos, int(float(row[stock_col] or 0)))
+                    except ValueError:
+                        stock[row[0]] = (pos, 0)
+        if with_sales:
+            width = len(SCHEMAS["DailySales"])
+            for pos, row in enumerate(value_ranges[-1].get("values", [])):
+                row = _pad_row(row, width)
+                sales.setdefault((row[0], row[1]), (pos, row[2:]))
+        return revision, stock, sales
+
+    def _read_guarded(self, ranges):
+        """(revision, value ranges) of `ranges`, read in one request together with the revision.
+
+        The revision is None while the revision sheet does not exist yet.
+        """
+        try:
+            value_ranges = self.sh.values_batch_get([f"'{REVISION_SHEET}'!A1"] + ranges).get("valueRanges", [])
+            cell = value_ranges.pop(0).get("values", [[""]])
+        except gspread.exceptions.APIError as e:
+            # Only the first guarded write of a spreadsheet gets here: its range cannot be parsed yet
+            if getattr(e.response, "status_code", None) != 400 or REVISION_SHEET not in str(e):
+                raise
+            value_ranges, cell = self.sh.values_batch_get(ranges).get("valueRanges", []), None
+        try:
+            revision = None if cell is None else int(cell[0][0])
+        except (IndexError, ValueError):
+            revision = self._revision_id()
+        return revision, value_ranges
+
+    def _revision_id(self):
+        # The revision cell was edited by hand; look the sheet id up instead
+        for sheet in self.sh.fetch_sheet_metadata({"fields": "sheets.properties(sheetId,title)"}).get("sheets", []):
+            if sheet["properties"]["title"] == REVISION_SHEET:
+                return sheet["properties"]["sheetId"]
+        return None
+
+    @staticmethod
+    def _swap_revision(revision):
+        """Requests that replace the revision sheet; the batch fails if `revision` is no longer current."""
+        new_id = random.randrange(1 << 30, (1 << 31) - 1)  # sheet ids are positive int32
+        requests = [] if revision is None else [{"deleteSheet": {"sheetId": revision}}]
+        return requests + [
+            {"addSheet": {"properties": {"sheetId": new_id, "title": REVISION_SHEET, "hidden": True,
+                                         "gridProperties": {"rowCount": 1, "columnCount": 1}}}},
+            {"updateCells": {"start": {"sheetId": new_id, "rowIndex": 0, "columnIndex": 0},
+                             "rows": [_row_data([new_id])], "fields": "userEnteredValue"}},
+        ]
+
+    def _commit_counters(self, appends, cell_updates, stock_deltas, sales_deltas):
+        """Conditional counter write: deltas on fresh InStock and DailySales values, applied only if nobody wrote since.
+
+        The counters and the revision are read in one request and the whole
+        write (rows, cells and the revision swap) is one batchUpdate, so it
+        either lands on exactly the values it was computed from or not at
+        all. A refused write changed nothing and is computed again on fresh
+        values. A day/channel without a DailySales row gets a new row.
+        """
+        for name in ["Products"] * bool(stock_deltas) + ["DailySales"] * bool(sales_deltas):
+            self[name]
+        for attempt in range(COUNTER_WRITE_ATTEMPTS):
+            revision, stock, sales = self._counter_state(bool(stock_deltas), bool(sales_deltas))
+            updates = list(cell_updates) + [
+                ("Products", pos, "InStock", str(current + int(stock_deltas[sku])))
+                for sku, (pos, current) in stock.items() if sku in stock_deltas
+            ]
+            new_days = []
+            for key, delta in sales_deltas.items():
+                if key in sales:
+                    pos, current = sales[key]
+                    updates += [("DailySales", pos, col, value)
+                                for col, value in zip(DAILY_SALES_COUNTERS, _add_counters(current, delta))]
+                else:
+                    new_days.append(list(key) + _add_counters([0] * len(delta), delta))
+            written = dict(appends)
+            if new_days:
+                written["DailySales"] = list(written.get("DailySales", [])) + new_days
+            try:
+                self._batch_update(written, updates, self._swap_revision(revision))
+            except gspread.exceptions.APIError as e:
+                if not _revision_conflict(e):
+                    raise
+                time.sleep(random.uniform(0.1, 0.5) * (attempt + 1))
+                continue
+            return written, updates
+        raise RuntimeError("تعارض في تحديث المخزون مع جهاز آخر، أعد المحاولة")
+
+    def rebuild_daily_sales(self):
+        """Rewrite DailySales from all Orders under the same revision guard as the counter writes.
+
+        A checkout that lands while the rollup is being computed changes the
+        revision, so the rewrite is refused and done again with that order
+        included. The marker is set in the same batch, and only if no other
+        terminal set it first.
+        """
+        sheet_id = self["DailySales"].id
+        for name in ("Orders", "Settings"):
+            self[name]
+        ranges = [f"'Orders'!A2:{chr(64 + len(SCHEMAS['Orders']))}",
+                  f"'DailySales'!A2:{chr(64 + len(SCHEMAS['DailySales']))}", "'Settings'!A2:B"]
+        for attempt in range(COUNTER_WRITE_ATTEMPTS):
+            revision, value_ranges = self._read_guarded(ranges)
+            orders, daily, settings = [r.get("values", []) for r in value_ranges]
+            marker_pos, built = _find_setting(settings, DAILY_SALES_BUILT_KEY)
+            if built:
+                return False
+            guard = self._swap_revision(revision)
+            if daily:
+                # Drop the old data rows; the new ones are appended after the header
+                guard.append({"deleteDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS",
+                                                            "startIndex": 1, "endIndex": 1 + len(daily)}}})
+            appends, updates = {"DailySales": _daily_sales_rows(orders)}, []
+            if marker_pos is None:
+                appends["Settings"] = [[DAILY_SALES_BUILT_KEY, "1"]]
+            else:
+                updates.append(("Settings", marker_pos, "Value", "1"))
+            try:
+                self._batch_update(appends, updates, guard)
+            except gspread.exceptions.APIError as e:
+                if not _revision_conflict(e):
+                    raise
+                time.sleep(random.uniform(0.1, 0.5) * (attempt + 1))
+                continue
+            return True
+        raise RuntimeError("تعارض في تحديث ملخص المبيعات مع جهاز آخر، أعد المحاولة")
+
+    def validate(self, name):
+        # ensure_worksheet checks the header once per process and repairs it if needed
+        self[name]
+        return True
+
+class SQLiteTable:
+    """Worksheet-like handle for a SQLite table so read_df/write_df work unchanged."""
+    def __init__(self, title):
+        self.title = title
+
+# Columns indexed in the SQLite backend (lookups by SKU, OrderID, CustomerID and date)
+SQLITE_INDEXES = {
+    "Products": ["SKU"],
+    "Customers": ["CustomerID"],
+    "Orders": ["OrderID", "CustomerID", "DateTime"],
+    "OrderItems": ["OrderID", "SKU"],
+    "StockMovements": ["SKU", "Timestamp"],
+    "Settings": ["Key"],
+    "Assets": ["Hash"],
+    "DailySales": ["Date"],
+}
+
+class SQLiteStorage:
+    """Local SQLite backend using the same SCHEMAS, one table per sheet.
+
+    Cells are stored as TEXT exactly like the Sheets backend, so read_df
+    applies the same typing to both. Row order is the rowid order.
+    """
+    kind = "sqlite"
+    # Already on local disk; a snapshot would not be any faster to load
+    snapshots = False
+
+    def __init__(self, path):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.key = f"sqlite:{os.path.abspath(path)}"
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.lock = threading.Lock()
+        for name in SCHEMAS:
+            self.ensure(name)
+
+    def __getitem__(self, name: str):
+        return SQLiteTable(name)
+
+    def ensure(self, name):
+        cols = ", ".join(f'"{c}" TEXT' for c in SCHEMAS[name])
+        with self.lock:
+            self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{name}" ({cols})')
+            for col in SQLITE_INDEXES.get(name, []):
+                self.conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{name}_{col}" ON "{name}" ("{col}")')
+        return SQLiteTable(name)
+
+    def validate(self, name):
+        return True
+
+    def busy(self):
+        return False
+
+    def _insert(self, name, rows):
+        cols = SCHEMAS[name]
+        placeholders = ", ".join("?" for _ in cols)
+        quoted = ", ".join(f'"{c}"' for c in cols)
+        padded = [(list(r) + [""] * len(cols))[:len(cols)] for r in rows]
+        self.conn.executemany(f'INSERT INTO "{name}" ({quoted}) VALUES ({placeholders})', padded)
+
+    def read_values(self, name):
+        cols = SCHEMAS[name]
+        quoted = ", ".join(f'"{c}"' for c in cols)
+        with self.lock:
+            rows = self.conn.execute(f'SELECT {quoted} FROM "{name}" ORDER BY rowid').fetchall()
+        return [list(cols)] + [["" if v is None else str(v) for v in r] for r in rows]
+
+    def read_tail(self, name, start):
+        cols = SCHEMAS[name]
+        quoted = ", ".join(f'"{c}"' for c in cols)
+        with self.lock:
+            rows = self.conn.execute(f'SELECT {quoted} FROM "{name}" ORDER BY rowid LIMIT -1 OFFSET ?', (start,)).fetchall()
+        return list(cols), [["" if v is None else str(v) for v in r] for r in rows]
+
+    def read_many(self, starts):
+        return {name: self.read_tail(name, start) for name, start in starts.items()}
+
+    def read_column(self, name, col):
+        with self.lock:
+            rows = self.conn.execute(f'SELECT "{col}" FROM "{name}" ORDER BY rowid').fetchall()
+        return ["" if r[0] is None else str(r[0]) for r in rows]
+
+    def write_values(self, name, values):
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute(f'DELETE FROM "{name}"')
+                self._insert(name, values[1:])
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def commit(self, appends, cell_updates, stock_deltas=None):
+        cell_updates = list(cell_updates)
+        with self.lock:
+            # IMMEDIATE takes the write lock up front, so other processes wait instead of conflicting
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for name, rows in appends.items():
+                    if rows:
+                        self._insert(name, rows)
+                for name, pos, col, value in cell_updates:
+                    self.conn.execute(
+                        f'UPDATE "{name}" SET "{col}" = ? WHERE rowid = (SELECT rowid FROM "{name}" ORDER BY rowid LIMIT 1 OFFSET ?)',
+                        (str(value), pos),
+                    )
+                for sku, change in (stock_deltas or {}).items():
+                    # Relative update: concurrent sales add up instead of overwriting each other
+                    found = self.conn.execute('SELECT rowid FROM "Products" WHERE "SKU" = ? ORDER BY rowid LIMIT 1', (sku,)).fetchone()
+                    if found is None:
+                        continue
+                    self.conn.execute(
+                        'UPDATE "Products" SET "InStock" = CAST(CAST(COALESCE(NULLIF("InStock", \'\'), \'0\') AS REAL) + ? AS INTEGER) WHERE rowid = ?',
+                        (int(change), found[0]),
+                    )
+                    value, pos = self.conn.execute(
+                        'SELECT "InStock", (SELECT COUNT(*) FROM "Products" WHERE rowid < ?) FROM "Products" WHERE rowid = ?',
+                        (found[0], found[0]),
+                    ).fetchone()
+                    cell_updates.append(("Products", pos, "InStock", str(value)))
+                for key, delta in _daily_sales_deltas(appends.get("Orders", [])).items():
+                    # Read-modify-write is safe here: BEGIN IMMEDIATE holds the write lock
+                    quoted = ", ".join(f'"{c}"' for c in DAILY_SALES_COUNTERS)
+                    found = self.conn.execute(
+                        f'SELECT rowid, {quoted} FROM "DailySales" WHERE "Date" = ? AND "Channel" = ? ORDER BY rowid LIMIT 1', key
+                    ).fetchone()
+                    if found is None:
+                        row = list(key) + _add_counters([0] * len(delta), delta)
+                        self._insert("DailySales", [row])
+                        appends = dict(appends, DailySales=list(appends.get("DailySales", [])) + [row])
+                        continue
+                    values = _add_counters(found[1:], delta)
+                    self.conn.execute(
+                        f'UPDATE "DailySales" SET {", ".join(f"{q} = ?" for q in quoted.split(", "))} WHERE rowid = ?',
+                        (*values, found[0]),
+                    )
+                    pos = self.conn.execute('SELECT COUNT(*) FROM "DailySales" WHERE rowid < ?', (found[0],)).fetchone()[0]
+                    cell_updates += [("DailySales", pos, col, value) for col, value in zip(DAILY_SALES_COUNTERS, values)]
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return appends, cell_updates
+
+    def rebuild_daily_sales(self):
+        # The write lock keeps checkouts out until the rollup and the marker are both written
+        cols = SCHEMAS["Orders"]
+        quoted = ", ".join(f'"{c}"' for c in cols)
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                built = self.conn.execute(
+                    'SELECT rowid, "Value" FROM "Settings" WHERE "Key" = ? ORDER BY rowid LIMIT 1', (DAILY_SALES_BUILT_KEY,)
+                ).fetchone()
+                if built is not None and built[1]:
+                    self.conn.execute("ROLLBACK")
+                    return False
+                orders = self.conn.execute(f'SELECT {quoted} FROM "Orders" ORDER BY rowid').fetchall()
+                self.conn.execute('DELETE FROM "DailySales"')
+                self._insert("DailySales", _daily_sales_rows([["" if v is None else str(v) for v in r] for r in orders]))
+                if built is None:
+                    self._insert("Settings", [[DAILY_SALES_BUILT_KEY, "1"]])
+                else:
+                    self.conn.execute('UPDATE "Settings" SET "Value" = ? WHERE rowid = ?', ("1", built[0]))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return True
+
+# ---------- Write-behind Outbox ----------
+class Outbox:
+    """Durable local queue of confirmed checkouts waiting to be written to storage.
+
+    A checkout is stored here first (one local SQLite insert) and the cashier
+    gets the invoice right away. A background thread merges pending orders
+    into one write per batch, hands it to the write coalescer, retries
+    failures with exponential backoff, and is idempotent per OrderID: an
+    entry that may already have been sent is skipped if its OrderID is found
+    in the Orders sheet.
+    """
+    BATCH_SIZE = 20
+    MAX_BACKOFF = 300
+    # Lease so a second flusher never sends the same entry; it must outlast the duplicate
+    # check before sending (one read, at most API_RETRY_DEADLINE) and is renewed while sending
+    CLAIM_SECONDS = 120
+    KEEP_DONE_SECONDS = 7 * 24 * 3600
+
+    def __init__(self, path):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id TEXT UNIQUE NOT NULL,
+            created_at REAL NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL DEFAULT 0,
+            last_error TEXT NOT NULL DEFAULT '',
+            done_at REAL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (done_at, next_attempt)")
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.storage = None  # attached on every rerun
+        self.cache = None
+        self.limiter = None
+        self.coalescer = None
+        self.last_error = ""
+        self._batch_limit = self.BATCH_SIZE
+        self.thread = threading.Thread(target=self._run, name="outbox-flusher", daemon=True)
+        self.thread.start()
+
+    def enqueue(self, order_id, appends, stock_deltas):
+        """Store one checkout durably. `appends` maps sheet -> rows of strings,
+        `stock_deltas` maps SKU -> InStock change."""
+        payload = json.dumps({"appends": appends, "stock_deltas": stock_deltas}, ensure_ascii=False)
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO outbox (order_id, created_at, payload) VALUES (?, ?, ?)",
+                (order_id, time.time(), payload),
+            )
+        self.wake.set()
+
+    def stats(self):
+        """Return (pending count, created_at of the oldest pending entry or None)."""
+        with self.lock:
+            count, oldest = self.conn.execute(
+                "SELECT COUNT(*), MIN(created_at) FROM outbox WHERE done_at IS NULL"
+            ).fetchone()
+        return count, oldest
+
+    def pending_stock_deltas(self):
+        """Sum of stock changes that are queued but not yet in storage."""
+        with self.lock:
+            payloads = self.conn.execute("SELECT payload FROM outbox WHERE done_at IS NULL").fetchall()
+        deltas = {}
+        for (payload,) in payloads:
+            for sku, change in json.loads(payload)["stock_deltas"].items():
+                deltas[sku] = deltas.get(sku, 0) + int(change)
+        return deltas
+
+    def _run(self):
+        while True:
+            self.wake.wait(timeout=5)
+            self.wake.clear()
+            if self.storage is None or self.coalescer is None:
+                continue
+            if self.limiter is not None:
+                # Checkout writes go ahead of page reads in the API budget
+                self.limiter.set_priority(PRIORITY_HIGH)
+            try:
+                if self.flush_once():
+                    self.wake.set()  # more may be pending
+            except BaseException as e:
+                # Nothing may end this loop: without it no later sale would ever be sent
+                logger.exception("Outbox flush failed")
+                self.last_error = str(e) or type(e).__name__
+
+    def flush_once(self):
+        storage = self.storage
+        now = time.time()
+        with self.lock:
+            # BEGIN IMMEDIATE makes select + claim exclusive across threads and processes
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                entries = self.conn.execute(
+                    "SELECT id, order_id, payload, attempts FROM outbox "
+                    "WHERE done_at IS NULL AND next_attempt <= ? ORDER BY id LIMIT ?",
+                    (now, self._batch_limit),
+                ).fetchall()
+                if not entries:
+                    self.conn.execute("DELETE FROM outbox WHERE done_at < ?", (now - self.KEEP_DONE_SECONDS,))
+                    self.conn.execute("COMMIT")
+                    return 0
+                ids = [e[0] for e in entries]
+                marks = ", ".join("?" for _ in ids)
+                # Claim before sending: a later retry of any of these checks for duplicates
+                self.conn.execute(
+                    f"UPDATE outbox SET attempts = attempts + 1, next_attempt = ? WHERE id IN ({marks})",
+                    [now + self.CLAIM_SECONDS] + ids,
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+        try:
+            retried = {order_id for _, order_id, _, attempts in entries if attempts > 0}
+            already_written = set()
+            if retried:
+                already_written = retried & set(storage.read_column("Orders", "OrderID"))
+            appends, stock_deltas, unseen = {}, {}, set()
+            for _, order_id, payload, _ in entries:
+                data = json.loads(payload)
+                if order_id in already_written:
+                    # Written by an attempt whose response was lost; the cache never saw it
+                    unseen.update(data["appends"])
+                    unseen.update(["Products"] if data["stock_deltas"] else [])
+                    unseen.update(["DailySales"] if "Orders" in data["appends"] else [])
+                    continue
+                for name, rows in data["appends"].items():
+                    appends.setdefault(name, []).extend(rows)
+                for sku, change in data["stock_deltas"].items():
+                    stock_deltas[sku] = stock_deltas.get(sku, 0) + int(change)
+            if appends or stock_deltas:
+                # The coalescer folds the write into the cache before resolving the
+                # future, so until the entries are marked done below a reader at
+                # worst counts a sale twice against stock, never zero times
+                self._wait_sent(self.coalescer.submit(storage, appends, [], stock_deltas), ids)
+        except Exception as e:
+            self.last_error = str(e)
+            with self.lock:
+                for entry_id, _, _, attempts in entries:
+                    delay = min(self.MAX_BACKOFF, 2 ** attempts) * random.uniform(0.5, 1.5)
+                    self.conn.execute(
+                        "UPDATE outbox SET next_attempt = ?, last_error = ? WHERE id = ?",
+                        (now + delay, str(e), entry_id),
+                    )
+            # Isolate a bad entry instead of blocking the whole batch
+            self._batch_limit = 1
+            return 0
+
+        if self.cache is not None:
+            self.cache.invalidate(storage.key, unseen)
+        with self.lock:
+            self.conn.execute(f"UPDATE outbox SET done_at = ?, last_error = '' WHERE id IN ({marks})", [time.time()] + ids)
+        self.last_error = ""
+        self._batch_limit = self.BATCH_SIZE
+        return len(entries)
+
+    def _wait_sent(self, future, ids):
+        """Wait for a batch handed to the coalescer, renewing its claim until the write ends.
+
+        Giving up earlier would let the claim run out while the write may still
+        land, and another flusher could then send the same orders again.
+        """
+        marks = ", ".join("?" for _ in ids)
+        while True:
+            try:
+                return future.result(timeout=self.CLAIM_SECONDS / 4)
+            except FutureTimeout:
+                with self.lock:
+                    self.conn.execute(
+                        f"UPDATE outbox SET next_attempt = ? WHERE done_at IS NULL AND id IN ({marks})",
+                        [time.time() + self.CLAIM_SECONDS] + ids,
+                    )
+
+# ---------- Write Coalescer ----------
+COALESCE_INTERVAL = 0.2  # seconds a flush waits for writes from other sessions to join it
+COALESCE_TIMEOUT = 120   # seconds a session waits for its write to be stored
+
+class WriteCoalescer:
+    """Single writer per process for every session's mutations.
+
+    Sessions (and the outbox) submit row appends, cell updates and stock
+    deltas and get a Future back. A background thread waits
+    COALESCE_INTERVAL for more writes, then merges everything pending for the
+    same storage into one storage.commit (one spreadsheets.batchUpdate on
+    Google Sheets) and folds the result into the sheet cache. Full rewrites
+    are not merged; they are written on their own, in submission order.
+    A failed commit fails every Future that was merged into it; if the
+    thread itself ever ends, every waiting Future fails and the next submit
+    starts a new thread.
+    """
+    def __init__(self, cache, limiter=None):
+        self.cache = cache
+        self.limiter = limiter
+        self.pending = []
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.restarts = 0
+        self.thread = None
+        self._start()
+
+    def _start(self):
+        self.thread = threading.Thread(target=self._run, name="write-coalescer", daemon=True)
+        self.thread.start()
+
+    def submit(self, storage, appends=None, cell_updates=(), stock_deltas=None, rewrite=None):
+        """Queue a write; `rewrite` is (sheet, values) to replace a whole sheet instead."""
+        op = {
+            "storage": storage,
+            "appends": {name: list(rows) for name, rows in (appends or {}).items() if rows},
+            "cell_updates": list(cell_updates),
+            "stock_deltas": dict(stock_deltas or {}),
+            "rewrite": rewrite,
+            "future": Future(),
+        }
+        with self.lock:
+            self.pending.append(op)
+            if not self.thread.is_alive():
+                logger.warning("Write coalescer thread was gone; starting a new one")
+                self.restarts += 1
+                self._start()
+        self.wake.set()
+        return op["future"]
+
+    def healthy(self):
+        return self.thread.is_alive()
+
+    @staticmethod
+    def _fail(ops, error):
+        for op in ops:
+            if not op["future"].done():
+                op["future"].set_exception(error)
+
+    def _run(self):
+        batch = []
+        try:
+            while True:
+                self.wake.wait()
+                time.sleep(COALESCE_INTERVAL)
+                with self.lock:
+                    batch, self.pending = self.pending, []
+                    self.wake.clear()
+                try:
+                    self._write_batch(batch)
+                except BaseException as e:
+                    # Whatever went wrong, the writer keeps running; this batch's waiters get the error
+                    logger.exception("Write coalescer batch failed")
+                    self._fail(batch, e if isinstance(e, Exception) else RuntimeError(repr(e)))
+        finally:
+            # Only reached when the thread is torn down: nobody may wait forever on a write
+            with self.lock:
+                batch, self.pending = batch + self.pending, []
+            self._fail(batch, RuntimeError("توقف حفظ البيانات، أعد المحاولة"))
+
+    def _write_batch(self, batch):
+        if self.limiter is not None:
+            # Writes go ahead of page reads in the API budget
+            self.limiter.set_priority(PRIORITY_HIGH)
+        group = []
+        for op in batch:
+            if group and (op["rewrite"] or group[0]["rewrite"] or op["storage"].key != group[0]["storage"].key):
+                self._flush(group)
+                group = []
+            group.append(op)
+        if group:
+            self._flush(group)
+
+    def _flush(self, group):
+        storage = group[0]["storage"]
+        try:
+            if group[0]["rewrite"]:
+                name, values = group[0]["rewrite"]
+                storage.write_values(name, values)
+            else:
+                appends, cell_updates, stock_deltas = {}, [], {}
+                for op in group:
+                    for name, rows in op["appends"].items():
+                        appends.setdefault(name, []).extend(rows)
+                    cell_updates.extend(op["cell_updates"])
+                    for sku, change in op["stock_deltas"].items():
+                        stock_deltas[sku] = stock_deltas.get(sku, 0) + int(change)
+                written, cell_updates = storage.commit(appends, cell_updates, stock_deltas)
+        except Exception as e:
+            self._fail(group, e)
+            return
+        try:
+            if group[0]["rewrite"]:
+                if name in SCHEMAS:
+                    self.cache.apply_write(storage.key, name, values)
+            else:
+                self.cache.apply_commit(storage.key, written, cell_updates)
+        except Exception:
+            # The write went through; only the cache is unsure, so read those sheets again
+            names = [group[0]["rewrite"][0]] if group[0]["rewrite"] else list(written) + [u[0] for u in cell_updates]
+            self.cache.invalidate(storage.key, names)
+        for op in group:
+            op["future"].set_result(None)
+
+# ---------- Sheet Cache ----------
+# Ledger sheets that only ever grow; a refresh fetches just the rows added since the last read
+APPEND_ONLY_SHEETS = ["Orders", "OrderItems", "StockMovements", "Assets"]
+SHEET_CACHE_TTL = 300  # Increased cache time to 5 minutes
+SHEET_CACHE_MAX_MB = 256  # Memory budget for all cached frames in the process
+BASE_VERSIONS = 4  # Recent raw frames kept per keyed sheet, so a save can diff against what it read
+
+def _frame_bytes(frame):
+    return int(frame.memory_usage(index=True, deep=True).sum())
+
+def _value_bytes(value, shared=None):
+    """Rough resident size of a derived value: its frames, arrays and strings and the containers
+    holding them; `shared` (the typed frame it was built from) is already counted."""
+    if value is shared:
+        return 0
+    if isinstance(value, pd.DataFrame):
+        return _frame_bytes(value)
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_value_bytes(k) + _value_bytes(v, shared) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_value_bytes(v, shared) for v in value)
+    return sys.getsizeof(value)
+
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_INTERVAL = 60  # seconds new versions of a sheet collect before its snapshot is written
+
+class SnapshotStore:
+    """Cached sheets on local disk, so a restarted app starts warm.
+
+    Each sheet is kept as two Parquet files (raw cells and typed frame) and a
+    JSON file with the cache bookkeeping and the storage token
+    (storage.modified()) seen before the data was read. The JSON file is
+    replaced last and names the Parquet files it belongs to, so a reader
+    never sees a mix.
+
+    Saves are batched: a background thread waits SNAPSHOT_INTERVAL after the
+    first pending save and then writes only the newest entry of each sheet,
+    so a busy checkout counter does not rewrite the Orders snapshot on every
+    sale. Whatever is still pending is written at interpreter exit.
+
+    `before_write`, if set, runs on the writer thread ahead of each batch;
+    SheetCache uses it to fetch fresh storage tokens off the read path.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.before_write = None
+        self.pending = {}
+        self.cond = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name="sheet-snapshots", daemon=True)
+        self.thread.start()
+        # Parquet writes import this on first use, which is refused once the interpreter is exiting
+        import pyarrow.pandas_compat  # noqa: F401
+        atexit.register(self.flush)
+
+    def _folder(self, storage_key):
+        return os.path.join(self.folder, hashlib.sha1(storage_key.encode()).hexdigest()[:16])
+
+    @staticmethod
+    def _signature(name):
+        return {"columns": SCHEMAS[name], "dtypes": DTYPES.get(name, {})}
+
+    def save(self, key, entry):
+        with self.cond:
+            self.pending[key] = entry
+            self.cond.notify()
+
+    def load(self, key):
+        """(raw frame, typed frame, meta) of a saved sheet, or None."""
+        storage_key, name = key
+        folder = self._folder(storage_key)
+        try:
+            with open(os.path.join(folder, f"{name}.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("format") != SNAPSHOT_FORMAT or meta.get("signature") != self._signature(name):
+                return None
+            raw = pd.read_parquet(os.path.join(folder, meta["raw"]))
+            typed = pd.read_parquet(os.path.join(folder, meta["typed"]))
+        except Exception:
+            return None
+        # Parquet gives Arrow-backed strings back as plain "string"
+        strings = {c: t for c, t in DTYPES.get(name, {}).items() if t.startswith("string") and c in typed.columns}
+        return raw, typed.astype(strings), meta
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            time.sleep(SNAPSHOT_INTERVAL)
+            if self.before_write is not None:
+                try:
+                    self.before_write()
+                except Exception:
+                    pass  # Snapshots then keep older tokens; a restart just re-reads more
+            self.flush()
+
+    def flush(self):
+        """Write every pending snapshot now."""
+        with self.write_lock:
+            with self.cond:
+                pending, self.pending = self.pending, {}
+            for key, entry in pending.items():
+                try:
+                    self._write(key, entry)
+                except Exception:
+                    pass  # A missing snapshot only costs a slower cold start
+
+    def _write(self, key, entry):
+        storage_key, name = key
+        folder = self._folder(storage_key)
+        os.makedirs(folder, exist_ok=True)
+        meta_path = os.path.join(folder, f"{name}.json")
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                old = json.load(f)
+        except (OSError, ValueError):
+            old = {}
+        stamp = f"{entry['version']}-{os.urandom(4).hex()}"
+        meta = {"format": SNAPSHOT_FORMAT, "signature": self._signature(name),
+                "raw": f"{name}.{stamp}.raw.parquet", "typed": f"{name}.{stamp}.typed.parquet",
+                "rows": entry["rows"], "last_row": entry["last_row"], "token": entry.get("token")}
+        entry["frame"].to_parquet(os.path.join(folder, meta["raw"]), index=False)
+        entry["typed"].to_parquet(os.path.join(folder, meta["typed"]), index=False)
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(meta_path + ".tmp", meta_path)
+        for field in ("raw", "typed"):
+            if old.get(field) and old[field] != meta[field]:
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(folder, old[field]))
+
+def _pad_row(row, width):
+    return (list(row) + [""] * width)[:width]
+
+def _parse_sheet_values(ws_title, all_values):
+    """Build a frame from header + data rows. Returns (frame, header_ok)."""
+    expected_headers = SCHEMAS[ws_title]
+    if not all_values:
+        # Return empty dataframe with expected columns
+        return pd.DataFrame(columns=expected_headers), True
+    first_row = all_values[0]
+    
+    # Check if headers match - if not, use expected headers
+    if len(first_row) >= len(expected_headers) and all(first_row[i] == expected_headers[i] for i in range(len(expected_headers))):
+        # Headers match, parse data normally
+        data_rows = [_pad_row(r, len(expected_headers)) for r in all_values[1:]]
+        return pd.DataFrame(data_rows, columns=expected_headers), True
+    
+    # Headers don't match, create empty dataframe; read_df warns (see SheetCache.header_ok)
+    return pd.DataFrame(columns=expected_headers), False
+
+class SheetCache:
+    """Process-wide cache of sheet frames, shared by all sessions.
+
+    Entries are keyed by (storage key, sheet name) and expire after
+    SHEET_CACHE_TTL. For APPEND_ONLY_SHEETS an entry remembers how many data
+    rows it has seen and the last of them; on refresh only the rows after
+    that point are fetched and concatenated onto the cached frame. A full
+    reload happens only when the header changed or the last seen row no
+    longer matches (the sheet shrank or history was edited).
+
+    load() refreshes several sheets with a single storage.read_many call, so
+    a page that needs three sheets costs one round-trip.
+
+    The cache is write-through: every successful write is folded into the
+    cached frame (apply_write / apply_commit) instead of invalidating it, so
+    readers see their own writes without another API read. Frames are never
+    modified in place; each new frame gets a new version number. A typed
+    frame is carried over to the new version with only the appended rows and
+    changed cells typed, rather than typed again from scratch.
+
+    A cache hit hands out the shared frame itself, with no pickling or copy.
+    Copy-on-write makes it read-only in effect: a session that edits its
+    frame gets private copies of just the columns it touches.
+
+    Every entry knows its size in bytes: raw frame, typed frame, derived
+    values and the older raw frames kept for keyed sheets (see base()). When
+    the total goes over `max_bytes` the least recently used entries are
+    dropped with all of these; the next read of such a sheet is a normal
+    full read.
+
+    For backends with `snapshots`, every typed entry is also saved to the
+    SnapshotStore. The first load after a restart serves the saved sheets
+    at once and checks storage.modified() in the background: if the data
+    changed since the snapshot, the sheets are marked stale and refreshed
+    (ledgers with a delta read from the saved rows).
+    """
+    def __init__(self, max_bytes=SHEET_CACHE_MAX_MB * 1024 * 1024, snapshots=None):
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.refresh_locks = {}
+        # key -> number of write-throughs so far; a read that overlapped one must not replace its result
+        self.writes = collections.Counter()
+        self.versions = itertools.count(1)
+        self.max_bytes = max_bytes
+        self.counters = collections.defaultdict(collections.Counter)
+        self.snapshots = snapshots
+        self.opened = set()
+        self.open_lock = threading.Lock()
+        # (storage key, keyed sheet) -> {version: raw frame} of its last BASE_VERSIONS versions
+        self.bases = {}
+        # Storage key -> storage whose typed sheets are saved to `snapshots`
+        self.persisted = {}
+        # Storage key -> storage.modified() from before the reads that follow; fetched in the background
+        self.tokens = {}
+        if snapshots is not None:
+            snapshots.before_write = self._refresh_tokens
+
+    def _key_lock(self, key):
+        """Short lock for swapping or changing one entry; never held across a storage call."""
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    def _refresh_lock(self, key):
+        """Lock readers hold while reading, typing or deriving a sheet, so sessions share one result.
+
+        Write-throughs never take it: the coalescer must not wait behind a slow read.
+        """
+        with self.lock:
+            return self.refresh_locks.setdefault(key, threading.Lock())
+
+    @staticmethod
+    def _entry_bytes(entry):
+        derived = sum(item[2] for item in entry.get("derived", {}).values())
+        return entry["bytes"] + entry.get("typed_bytes", 0) + entry.get("base_bytes", 0) + derived
+
+    def _store(self, key, entry):
+        """Put an entry in as the most recently used one, then evict down to the budget."""
+        if entry.get("typed_version") != entry["version"]:
+            # A typed frame of an older version must not be kept (or counted) alongside the new one
+            for field in ("typed", "typed_version", "typed_bytes", "derived"):
+                entry.pop(field, None)
+        else:
+            self._persist(key, entry)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            if key[1] in KEY_COLUMNS and entry["header_ok"]:
+                bases = self.bases.setdefault(key, collections.OrderedDict())
+                bases[entry["version"]] = (entry["frame"], entry["bytes"])
+                while len(bases) > BASE_VERSIONS:
+                    bases.popitem(last=False)
+                # Older versions share unchanged columns with this one, so this overstates them a little
+                entry["base_bytes"] = sum(size for version, (_, size) in bases.items() if version != entry["version"])
+            self._evict()
+
+    def _evict(self):
+        # Called with self.lock held; the most recently used entry always stays
+        total = sum(self._entry_bytes(e) for e in self.entries.values())
+        while total > self.max_bytes and len(self.entries) > 1:
+            key, entry = self.entries.popitem(last=False)
+            self.bases.pop(key, None)
+            total -= self._entry_bytes(entry)
+            self.counters[key]["evictions"] += 1
+
+    def get(self, storage, name):
+        return self.load(storage, [name])[name]
+
+    def load(self, storage, names):
+        """Frames for `names`, refreshing every stale one in one read_many call."""
+        entries = self._load(storage, names)
+        return {name: entries[name]["frame"] for name in names}
+
+    def _open_snapshots(self, storage):
+        """Once per storage: serve the saved sheets and revalidate them in the background."""
+        with self.open_lock:
+            if storage.key in self.opened:
+                return
+            self.opened.add(storage.key)
+            if self.snapshots is None or not storage.snapshots:
+                return
+            restored = {}
+            for name in SCHEMAS:
+                key = (storage.key, name)
+                saved = None if key in self.entries else self.snapshots.load(key)
+                if saved is None:
+                    continue
+                raw, typed, meta = saved
+                version = next(self.versions)
+                self._store(key, {"frame": raw, "rows": meta["rows"], "last_row": meta["last_row"],
+                                  "header_ok": True, "fetched_at": time.time(), "version": version,
+                                  "bytes": _frame_bytes(raw), "token": meta["token"], "typed": typed,
+                                  "typed_version": version, "typed_bytes": _frame_bytes(typed)})
+                restored[name] = meta["token"]
+            self.persisted[storage.key] = storage
+        threading.Thread(target=self._revalidate, args=(storage, restored),
+                         name="sheet-revalidate", daemon=True).start()
+
+    def _revalidate(self, storage, restored):
+        try:
+            token = storage.modified()
+        except Exception:
+            token = None
+        if token is not None:
+            self.tokens[storage.key] = token
+        changed = [name for name, saved in restored.items() if token is None or saved != token]
+        if not changed:
+            return
+        self.invalidate(storage.key, changed)
+        try:
+            # One batched read, then type (and save) each sheet ahead of the pages that need it
+            self._load(storage, changed)
+            for name in changed:
+                self.typed(storage, name)
+        except Exception:
+            pass  # The next page load reads them instead
+
+    def _load(self, storage, names):
+        self._open_snapshots(storage)
+        keys = sorted({(storage.key, name) for name in names})
+        locks = [self._refresh_lock(key) for key in keys]
+        # One refresh per sheet at a time; other sessions wait and reuse it.
+        # Locks are taken in sorted order so overlapping page loads cannot deadlock.
+        for lock in locks:
+            lock.acquire()
+        try:
+            starts, tails, loaded, seen = {}, {}, {}, {}
+            # Low on API budget: dashboards and reports make do with what is cached
+            serve_stale = storage.busy()
+            for key in keys:
+                name = key[1]
+                entry = self.entries.get(key)
+                if entry is not None and (serve_stale or time.time() - entry["fetched_at"] < SHEET_CACHE_TTL):
+                    with self.lock:
+                        if key in self.entries:
+                            self.entries.move_to_end(key)
+                        self.counters[key]["hits"] += 1
+                    loaded[name] = entry
+                    continue
+                with self.lock:
+                    self.counters[key]["misses"] += 1
+                    seen[name] = (entry, self.writes[key])
+                if entry is not None and name in APPEND_ONLY_SHEETS and entry["rows"] > 0:
+                    # Start at the last seen row so we can check it is still the same
+                    starts[name] = entry["rows"] - 1
+                    tails[name] = entry
+                else:
+                    starts[name] = 0
+            if starts:
+                # Fetched before this read started, so the data is at least as new as the token
+                token = self.tokens.get(storage.key)
+                fetched = storage.read_many(starts)
+                for name, start in starts.items():
+                    header, rows = fetched[name]
+                    new_entry = None
+                    if name in tails:
+                        new_entry = self._apply_tail(name, tails[name], header, rows)
+                        if new_entry is None and start:
+                            header, rows = storage.read_tail(name, 0)
+                    if new_entry is None:
+                        new_entry = self._apply_full(name, header, rows)
+                    new_entry["token"] = token
+                    key = (storage.key, name)
+                    with self._key_lock(key):
+                        # A write-through (or invalidate/evict) during the read wins; this read may predate it
+                        if self.entries.get(key) is seen[name][0] and self.writes[key] == seen[name][1]:
+                            self._store(key, new_entry)
+                    loaded[name] = new_entry
+            return loaded
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def _apply_full(self, name, header, rows):
+        values = [header] + rows if header or rows else []
+        frame, header_ok = _parse_sheet_values(name, values)
+        count = len(rows) if header_ok else 0
+        last_row = _pad_row(rows[-1], len(SCHEMAS[name])) if count else None
+        return {"frame": frame, "rows": count, "last_row": last_row, "header_ok": header_ok,
+                "fetched_at": time.time(), "version": next(self.versions), "bytes": _frame_bytes(frame)}
+
+    def _apply_tail(self, name, entry, header, tail):
+        """Add rows after the last seen one; None when a full reload is needed."""
+        width = len(SCHEMAS[name])
+        if _pad_row(header, width) != SCHEMAS[name]:
+            return None
+        if not tail or _pad_row(tail[0], width) != entry["last_row"]:
+            return None
+        new_rows = [_pad_row(r, width) for r in tail[1:]]
+        if not new_rows:
+            return dict(entry, fetched_at=time.time())
+        added = pd.DataFrame(new_rows, columns=SCHEMAS[name])
+        frame = pd.concat([entry["frame"], added], ignore_index=True)
+        new_entry = dict(entry, frame=frame, rows=entry["rows"] + len(new_rows), last_row=new_rows[-1],
+                         fetched_at=time.time(), version=next(self.versions),
+                         bytes=entry["bytes"] + _frame_bytes(added))
+        return self._carry_typed(name, entry, new_entry, [], added)
+
+    def typed(self, storage, name):
+        """The frame with DTYPES applied; computed once per version and shared by all sessions."""
+        return self.typed_at(storage, name)[0]
+
+    def typed_at(self, storage, name):
+        """(typed frame, the version it was built from), taken together."""
+        entry = self._load(storage, [name])[name]
+        key = (storage.key, name)
+        with self._key_lock(key):
+            if entry.get("typed_version") == entry["version"]:
+                return entry["typed"], entry["typed_version"]
+        with self._refresh_lock(key):
+            with self._key_lock(key):
+                if entry.get("typed_version") == entry["version"]:
+                    return entry["typed"], entry["typed_version"]
+            typed = _type_frame(name, entry["frame"])
+            with self._key_lock(key):
+                entry.update(typed=typed, typed_bytes=_frame_bytes(typed), typed_version=entry["version"], derived={})
+                with self.lock:
+                    self._evict()
+                self._persist(key, entry)
+                return entry["typed"], entry["typed_version"]
+
+    def _refresh_tokens(self):
+        """Fetch storage.modified() of every snapshot backend for the reads that follow."""
+        for storage_key, storage in list(self.persisted.items()):
+            try:
+                self.tokens[storage_key] = storage.modified()
+            except Exception:
+                pass
+
+    def _persist(self, key, entry):
+        if self.snapshots is not None and key[0] in self.persisted and entry["header_ok"]:
+            self.snapshots.save(key, entry)
+
+    def _carry_typed(self, name, entry, new_entry, updates, added):
+        """Give `new_entry` the typed frame of `entry` with only the changed cells and added rows typed.
+
+        `updates` are (position, column, raw value) and `added` the raw frame
+        of appended rows. Derived values that came with an `extend` function
+        are extended over the added rows; the others are rebuilt on next use.
+        Nothing is carried when `entry` was never typed.
+        """
+        if entry.get("typed_version") != entry["version"]:
+            return new_entry
+        typed = entry["typed"]
+        typed_bytes = entry["typed_bytes"]
+        if updates:
+            typed = _patch_typed(name, typed, updates)
+        start = len(typed)
+        if len(added):
+            typed, added_bytes = _append_typed(name, typed, added)
+            typed_bytes += added_bytes
+        derived = {}
+        if not updates:
+            for label, (value, extend, size) in entry.get("derived", {}).items():
+                value = extend(value, typed, start) if extend is not None else None
+                if value is not None:
+                    # Measuring again would walk the whole value on every write; scale by rows instead
+                    derived[label] = (value, extend, size * len(typed) // max(start, 1))
+        new_entry.update(typed=typed, typed_version=new_entry["version"], typed_bytes=typed_bytes,
+                         derived=derived)
+        return new_entry
+
+    def derive(self, storage, name, label, build, extend=None):
+        """`build(typed frame)`, computed once per version and shared like the typed frame.
+
+        With `extend(value, typed frame, first new row)` the value survives
+        appends: it is extended over the new rows instead of rebuilt.
+        `extend` may return None to have it rebuilt.
+        """
+        frame = self.typed(storage, name)
+        entry = self.entries.get((storage.key, name))
+        if entry is None or entry.get("typed") is not frame:
+            # Evicted or replaced meanwhile; still correct, just not kept
+            return build(frame)
+        key = (storage.key, name)
+        with self._key_lock(key):
+            derived = entry.setdefault("derived", {})
+            if label in derived:
+                return derived[label][0]
+        with self._refresh_lock(key):
+            with self._key_lock(key):
+                if label in derived:
+                    return derived[label][0]
+            value = build(frame)
+            size = _value_bytes(value, shared=frame)
+            with self._key_lock(key):
+                value = derived.setdefault(label, (value, extend, size))[0]
+                with self.lock:
+                    self._evict()
+                return value
+
+    def version(self, storage_key, name):
+        entry = self.entries.get((storage_key, name))
+        return entry["version"] if entry is not None else 0
+
+    def apply_write(self, storage_key, name, values):
+        """Write-through for a full rewrite: the cache now holds exactly `values`."""
+        key = (storage_key, name)
+        with self._key_lock(key):
+            self.writes[key] += 1
+            self._store(key, self._apply_full(name, values[0] if values else [], values[1:]))
+
+    def apply_commit(self, storage_key, appends, cell_updates):
+        """Write-through for storage.commit: fold the rows and cells into the cached frames."""
+        updates_by_sheet = {}
+        for name, pos, col, value in cell_updates:
+            updates_by_sheet.setdefault(name, []).append((pos, col, value))
+        for name in set(appends) | set(updates_by_sheet):
+            key = (storage_key, name)
+            with self._key_lock(key):
+                self.writes[key] += 1
+                entry = self.entries.get(key)
+                if entry is None or not entry["header_ok"]:
+                    continue
+                cols = SCHEMAS[name]
+                frame = entry["frame"]
+                updates = updates_by_sheet.get(name, [])
+                if any(pos >= len(frame) for pos, _, _ in updates):
+                    # The cache is behind the sheet; read it again next time
+                    with self.lock:
+                        self.entries.pop(key, None)
+                    continue
+                if updates:
+                    # Readers may still hold the old frame; copy-on-write duplicates only the touched columns
+                    frame = frame.copy(deep=False)
+                    for pos, col, value in updates:
+                        frame.iat[pos, cols.index(col)] = str(value)
+                added = pd.DataFrame([_pad_row(r, len(cols)) for r in appends.get(name, [])], columns=cols)
+                if len(added):
+                    frame = pd.concat([frame, added], ignore_index=True)
+                rows = entry["rows"] + len(added)
+                last_row = [str(v) for v in frame.iloc[-1].tolist()] if rows else None
+                # Other edits may have landed between the read and this write; the snapshot must not vouch for it
+                new_entry = dict(entry, frame=frame, rows=rows, last_row=last_row, version=next(self.versions),
+                                 bytes=entry["bytes"] + (_frame_bytes(added) if len(added) else 0), token=None)
+                self._store(key, self._carry_typed(name, entry, new_entry,
+                                                   [(pos, col, str(value)) for pos, col, value in updates], added))
+
+    def header_ok(self, storage_key, name):
+        """False when the cached sheet was read with a wrong header row (and so holds no rows)."""
+        entry = self.entries.get((storage_key, name))
+        return entry is None or entry["header_ok"]
+
+    def snapshot(self, storage_key, name):
+        """(frame as last read from storage, its version), or (None, 0) if it cannot be trusted."""
+        entry = self.entries.get((storage_key, name))
+        if entry is None or not entry["header_ok"]:
+            return None, 0
+        return entry["frame"], entry["version"]
+
+    def base(self, storage_key, name, version):
+        """The raw frame of a keyed sheet at an earlier `version`, or None once it is no longer kept."""
+        with self.lock:
+            frame, _ = self.bases.get((storage_key, name), {}).get(version, (None, 0))
+            return frame
+
+    def invalidate(self, storage_key, names):
+        """Mark sheets stale; ledgers keep their rows so the next read is a delta."""
+        with self.lock:
+            for name in names:
+                entry = self.entries.get((storage_key, name))
+                if entry is not None:
+                    self.entries[(storage_key, name)] = dict(entry, fetched_at=0)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bases.clear()
+
+    def stats(self, storage_key):
+        """Per-sheet hits, misses, evictions and resident bytes, plus the total for the process."""
+        with self.lock:
+            rows = []
+            for key in sorted(k for k in set(self.entries) | set(self.counters) if k[0] == storage_key):
+                entry = self.entries.get(key)
+                counters = self.counters[key]
+                rows.append({"sheet": key[1], "hits": counters["hits"], "misses": counters["misses"],
+                             "evictions": counters["evictions"],
+                             "bytes": self._entry_bytes(entry) if entry is not None else 0})
+            total = sum(self._entry_bytes(e) for e in self.entries.values())
+        return rows, total
+
+def _type_column(col, dtype, values):
+    if dtype == "category":
+        values = values.fillna("").astype(str)
+        known = CATEGORIES.get(col, [])
+        extra = sorted(set(values.unique()) - set(known))
+        return pd.Series(pd.Categorical(values, categories=known + extra), index=values.index)
+    if dtype.startswith("datetime64"):
+        # Sheets hold naive Cairo wall-clock times; an ambiguous hour at the DST change is read as standard time
+        parsed = pd.to_datetime(values, format="ISO8601", errors="coerce")
+        return parsed.dt.tz_localize(TZ, ambiguous=np.zeros(len(parsed), dtype=bool), nonexistent="shift_forward")
+    if dtype.startswith("string"):
+        return values.fillna("").astype(str).astype(dtype)
+    return pd.to_numeric(values, errors="coerce").fillna(0).astype(dtype)
+
+def _type_frame(ws_title, frame):
+    """Apply the sheet's DTYPES in one pass; text columns are left as they are."""
+    types = DTYPES.get(ws_title, {})
+    columns = {}
+    for col in frame.columns:
+        if col in types:
+            columns[col] = _type_column(col, types[col], frame[col])
+        else:
+            columns[col] = frame[col].astype(str) if frame[col].dtype != object else frame[col]
+    return pd.DataFrame(columns, index=frame.index, columns=frame.columns)
+
+def _union_categories(col, old, new):
+    """Two categorical columns recoded onto one category list, ordered as _type_column orders it."""
+    if old.cat.categories.equals(new.cat.categories):
+        return old, new
+    known = CATEGORIES.get(col, [])
+    extra = sorted((set(old.cat.categories) | set(new.cat.categories)) - set(known))
+    return old.cat.set_categories(known + extra), new.cat.set_categories(known + extra)
+
+def _append_typed(ws_title, typed, added):
+    """(`typed` with the raw rows `added` typed on their own and appended, bytes of those rows)."""
+    new = _type_frame(ws_title, added)
+    if not len(typed):
+        return new, _frame_bytes(new)
+    typed = typed.copy(deep=False)
+    for col in typed.columns:
+        if isinstance(typed[col].dtype, pd.CategoricalDtype):
+            typed[col], new[col] = _union_categories(col, typed[col], new[col])
+    return pd.concat([typed, new], ignore_index=True), _frame_bytes(new)
+
+def _patch_typed(ws_title, typed, updates):
+    """`typed` with the (position, column, raw value) cells replaced, each column typed as _type_frame does."""
+    cells = {}
+    for pos, col, value in updates:
+        cells.setdefault(col, {})[pos] = value
+    # Readers may still hold the old frame; copy-on-write duplicates only the touched columns
+    typed = typed.copy(deep=False)
+    for col, values in cells.items():
+        new = _type_frame(ws_title, pd.DataFrame({col: list(values.values())}, index=list(values), dtype=object))[col]
+        if isinstance(typed[col].dtype, pd.CategoricalDtype):
+            typed[col], new = _union_categories(col, typed[col], new)
+        typed.iloc[list(values), typed.columns.get_loc(col)] = new.array
+    return typed
+
+# ---------- Report Cube ----------
+class ReportCube:
+    """Per-day sales aggregates that only ever fold in the rows added since the last refresh.
+
+    - items:  Date x SKU x Channel  -> Qty, Revenue (from OrderItems)
+    - orders: Date x Hour x Channel -> Orders, Total (from Orders)
+
+    Orders and OrderItems are ledgers, so new rows are always at the end. If
+    the last row seen before is no longer where it was (a rewrite or a
+    manual edit of the sheet), the cube is built again from scratch. A date
+    range is a binary-search slice of the cube, which is sorted by Date.
+
+    An item row can be read before the row of its order (another device's
+    checkout lands between the two reads). Such rows wait in a pending
+    buffer and are folded in once their order shows up.
+    """
+    ITEM_KEYS = ["Date", "SKU", "Channel"]
+    ORDER_KEYS = ["Date", "Hour", "Channel"]
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def refresh(self, storage):
+        orders = self.cache.typed(storage, "Orders")
+        items = self.cache.typed(storage, "OrderItems")
+        with self.lock:
+            state = self.states.get(storage.key)
+            if state is None or not self._same_prefix(state, orders, items):
+                state = self.states[storage.key] = {
+                    "orders_seen": 0, "items_seen": 0, "marks": (None, None),
+                    "order_keys": {}, "names": {}, "pending": None,
+                    "items": pd.DataFrame(columns=self.ITEM_KEYS + ["Qty", "Revenue"]),
+                    "orders": pd.DataFrame(columns=self.ORDER_KEYS + ["Orders", "Total"]),
+                }
+            self._add(state, orders.iloc[state["orders_seen"]:], items.iloc[state["items_seen"]:])
+            state["orders_seen"], state["items_seen"] = len(orders), len(items)
+            state["marks"] = (self._mark(orders, ["OrderID"]), self._mark(items, ["OrderID", "SKU"]))
+            return state
+
+    @staticmethod
+    def _mark(df, cols):
+        return tuple(df[c].iat[-1] for c in cols) if len(df) else None
+
+    def _same_prefix(self, state, orders, items):
+        if len(orders) < state["orders_seen"] or len(items) < state["items_seen"]:
+            return False
+        seen = (self._mark(orders.iloc[:state["orders_seen"]], ["OrderID"]),
+                self._mark(items.iloc[:state["items_seen"]], ["OrderID", "SKU"]))
+        return seen == state["marks"]
+
+    @staticmethod
+    def _merge(cube, delta, keys):
+        if delta.empty:
+            return cube
+        if not cube.empty:
+            delta = pd.concat([cube, delta], ignore_index=True)
+        return delta.groupby(keys, as_index=False, sort=True).sum()
+
+    def _add(self, state, new_orders, new_items):
+        if not new_orders.empty:
+            local = new_orders["DateTime"].dt.tz_localize(None)
+            info = pd.DataFrame({
+                "OrderID": new_orders["OrderID"].to_numpy(),
+                "Date": local.dt.normalize().to_numpy(),
+                "Hour": local.dt.hour.to_numpy(),
+                "Channel": new_orders["Channel"].astype(str).to_numpy(),
+                "Total": new_orders["Total"].to_numpy(),
+            }).dropna(subset=["Date"])
+            state["order_keys"].update(zip(info["OrderID"], zip(info["Date"], info["Channel"])))
+            info = info.assign(Orders=1, Hour=info["Hour"].astype("int64"))
+            state["orders"] = self._merge(state["orders"], info[self.ORDER_KEYS + ["Orders", "Total"]], self.ORDER_KEYS)
+        if state["pending"] is not None:
+            new_items = pd.concat([state["pending"], new_items], ignore_index=True)
+            state["pending"] = None
+        if not new_items.empty:
+            # Items join their order's day and channel; rows of orders not seen yet wait for them
+            keys = [state["order_keys"].get(order_id) for order_id in new_items["OrderID"]]
+            known = np.array([k is not None for k in keys], dtype=bool)
+            if not known.all():
+                state["pending"] = new_items[~known]
+            rows = new_items[known]
+            keys = [k for k in keys if k is not None]
+            state["names"].update(zip(rows["SKU"], rows["Name"].astype(str)))
+            delta = pd.DataFrame({
+                "Date": pd.to_datetime([k[0] for k in keys]),
+                "SKU": rows["SKU"].to_numpy(),
+                "Channel": [k[1] for k in keys],
+                "Qty": rows["Qty"].to_numpy(),
+                "Revenue": rows["LineTotal"].to_numpy(),
+            })
+            state["items"] = self._merge(state["items"], delta, self.ITEM_KEYS)
+
+    @staticmethod
+    def slice(cube, start, end):
+        """Rows of a cube dated start..end (inclusive)."""
+        dates = cube["Date"].to_numpy(dtype="datetime64[ns]")
+        first = np.searchsorted(dates, pd.Timestamp(start).to_datetime64(), side="left")
+        last = np.searchsorted(dates, pd.Timestamp(end).to_datetime64(), side="right")
+        return cube.iloc[first:last]
+
+# ---------- Customer Search ----------
+# Tashkeel, superscript alef and tatweel are dropped; hamza/alef forms, alef maqsura and ta marbuta are folded
+ARABIC_FOLD = str.maketrans({**{chr(c): None for c in range(0x064B, 0x0653)}, "ٰ": None, "ـ": None,
+                             "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ى": "ي", "ة": "ه"})
+ARABIC_DIGITS = str.maketrans("٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹", "0123456789" * 2)
+CUSTOMER_SEARCH_LIMIT = 20
+PHONE_MIN_SUFFIX = 3
+
+def normalize_arabic(text):
+    """Lower-case text with Arabic letter variants folded, for matching names."""
+    return str(text).translate(ARABIC_FOLD).translate(ARABIC_DIGITS).casefold()
+
+def normalize_phone(value):
+    """Digits of an Egyptian phone without +20/0020 or the leading 0, e.g. "+20 10 1234 5678" -> "1012345678".
+
+    The country code is only dropped from full-length numbers, so a short or half-typed
+    "+20 10 1234" stays "20101234"."""
+    digits = re.sub(r"\D", "", str(value).translate(ARABIC_DIGITS))
+    if digits.startswith("00"):
+        digits = digits[2:]
+    if digits.startswith("20") and len(digits) > 10:
+        digits = digits[2:]
+    return digits.lstrip("0")
+
+def _name_grams(name, closed=True):
+    # Bigrams of each word padded with spaces, so one-letter words and word starts count too;
+    # a query leaves the word ends open because the last word may still be half typed
+    grams = set()
+    for token in re.findall(r"\w+", name):
+        padded = f" {token} " if closed else f" {token}"
+        grams.update({padded[i:i + 2] for i in range(len(padded) - 1)})
+    return grams
+
+class CustomerSearchIndex:
+    """Name bigram postings and phone suffixes over the Customers rows, kept in sync by row position.
+
+    sync() only re-indexes rows whose Name or Phone changed since the last
+    version it saw, so saving a customer touches one row. Names match by
+    shared bigrams (so a wrong or missing letter still finds the customer)
+    and phones by suffix or by prefix of the normalized digits.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.rows = []        # per position: ((name, phone), normalized name, grams, normalized phone)
+        self.postings = {}    # bigram -> set of positions
+        self.arrays = {}      # bigram -> sorted positions array, rebuilt after a change
+        self.suffixes = {}    # phone suffix -> set of positions
+        self.sorted_phones = None
+        self.gram_counts = np.zeros(0, dtype=np.int64)
+
+    def sync(self, version, df):
+        """Bring the index up to `df`, the Customers frame of cache `version` (both from one typed_at call)."""
+        with self.lock:
+            if version == self.version and len(df) == len(self.rows):
+                return
+            raw = list(zip(df["Name"].astype(str), df["Phone"].astype(str)))
+            for pos, values in enumerate(raw):
+                if pos < len(self.rows):
+                    if self.rows[pos][0] == values:
+                        continue
+                    self._remove(pos)
+                    self.rows[pos] = self._entry(pos, values)
+                else:
+                    self.rows.append(self._entry(pos, values))
+            while len(self.rows) > len(raw):
+                self._remove(len(self.rows) - 1)
+                self.rows.pop()
+            self.version = version
+            self.gram_counts = np.array([len(r[2]) for r in self.rows], dtype=np.int64)
+            if self.sorted_phones is None:
+                # Built in one sort the first time; kept sorted by insort/del after that
+                self.sorted_phones = sorted((r[3], pos) for pos, r in enumerate(self.rows) if r[3])
+
+    def _entry(self, pos, values):
+        name = normalize_arabic(values[0])
+        grams = _name_grams(name)
+        for gram in grams:
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = set()
+            posting.add(pos)
+        if self.arrays:
+            for gram in grams:
+                self.arrays.pop(gram, None)
+        phone = normalize_phone(values[1])
+        for i in range(len(phone) - PHONE_MIN_SUFFIX + 1):
+            self.suffixes.setdefault(phone[i:], set()).add(pos)
+        if self.sorted_phones is not None and phone:
+            bisect.insort(self.sorted_phones, (phone, pos))
+        return values, name, grams, phone
+
+    def _remove(self, pos):
+        _, _, grams, phone = self.rows[pos]
+        for gram in grams:
+            self.postings[gram].discard(pos)
+            self.arrays.pop(gram, None)
+        for i in range(len(phone) - PHONE_MIN_SUFFIX + 1):
+            self.suffixes[phone[i:]].discard(pos)
+        if self.sorted_phones is not None and phone:
+            i = bisect.bisect_left(self.sorted_phones, (phone, pos))
+            if i < len(self.sorted_phones) and self.sorted_phones[i] == (phone, pos):
+                del self.sorted_phones[i]
+
+    def search(self, query, limit=CUSTOMER_SEARCH_LIMIT):
+        """Row positions of the best matches for `query`, best first."""
+        with self.lock:
+            compact = re.sub(r"[\s+\-()]", "", str(query).translate(ARABIC_DIGITS))
+            if compact.isdigit():
+                return self._search_phone(normalize_phone(compact), limit)
+            return self._search_name(normalize_arabic(query).strip(), limit)
+
+    def _search_phone(self, digits, limit):
+        if not digits:
+            return []
+        scores = {}
+        if len(digits) >= PHONE_MIN_SUFFIX:
+            for pos in self.suffixes.get(digits, ()):
+                scores[pos] = 2.0 if self.rows[pos][3] == digits else 1.0
+        # Typed from the start of the number: every phone with that prefix
+        i = bisect.bisect_left(self.sorted_phones, (digits, -1))
+        while i < len(self.sorted_phones) and self.sorted_phones[i][0].startswith(digits):
+            scores.setdefault(self.sorted_phones[i][1], 1.0)
+            i += 1
+        return sorted(scores, key=lambda pos: (-scores[pos], pos))[:limit]
+
+    def _search_name(self, name, limit):
+        grams = _name_grams(name, closed=False)
+        lists = []
+        for gram in grams:
+            if gram in self.postings:
+                if gram not in self.arrays:
+                    self.arrays[gram] = np.fromiter(self.postings[gram], dtype=np.int64)
+                lists.append(self.arrays[gram])
+        if not lists:
+            return []
+        shared = np.bincount(np.concatenate(lists), minlength=len(self.rows))
+        # Short queries must match fully; longer ones may miss some bigrams (typos, half-typed words)
+        needed = len(grams) if len(name) <= 2 else max(1, int(np.ceil(len(grams) * 0.6)))
+        candidates = np.flatnonzero(shared >= needed)
+        if candidates.size == 0:
+            return []
+        similarity = shared[candidates] / (len(grams) + self.gram_counts[candidates] - shared[candidates])
+        if candidates.size > limit * 10:
+            keep = np.argpartition(-similarity, limit * 10)[:limit * 10]
+            candidates, similarity = candidates[keep], similarity[keep]
+        # Names that contain the query as typed rank above fuzzy matches
+        scores = [(sim + (1.0 if name in self.rows[pos][1] else 0.0), pos) for pos, sim in zip(candidates.tolist(), similarity.tolist())]
+        scores.sort(key=lambda s: (-s[0], s[1]))
+        return [pos for _, pos in scores[:limit]]
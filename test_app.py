@@ -77,7 +77,9 @@ def test_schemas():
         "Orders": ["OrderID","DateTime","CustomerID","CustomerName","CustomerAddress","Channel","Subtotal","Discount","Delivery","Deposit","Total","Status","Notes"],
         "OrderItems": ["OrderID","SKU","Name","Qty","UnitPrice","LineTotal"],
         "StockMovements": ["Timestamp","SKU","Change","Reason","Reference","Note"],
-        "Settings": ["Key","Value"]
+        "Settings": ["Key","Value"],
+        "Assets": ["Hash","Part","Data"],
+        "DailySales": ["Date","Channel","Orders","Gross","Discount","Delivery","Deposit","Total"]
     }
     
     print("✅ All schemas defined correctly")
@@ -89,6 +91,7 @@ def test_files_exist():
     
     required_files = [
         "app.py",
+        "pos_core.py",
         "requirements.txt", 
         "runtime.txt",
         "check_dependencies.py",
@@ -0,0 +1,678 @@
+"""Tests for the storage engine in pos_core.py (run with: python -m pytest -q)."""
+import copy
+import re
+import sqlite3
+import threading
+from concurrent.futures import Future
+
+import gspread
+import pandas as pd
+import pytest
+
+import pos_core
+from pos_core import (
+    SCHEMAS, DAILY_SALES_BUILT_KEY, REVISION_SHEET, SHEET_CACHE_TTL, COUNTER_WRITE_ATTEMPTS, SheetsStorage, SQLiteStorage, Outbox, SheetCache, SnapshotStore,
+    CustomerSearchIndex, normalize_arabic, normalize_phone, _type_frame,
+)
+
+# ---------- SQLite Storage ----------
+def order_row(order_id, when="2026-10-01 10:00:00", channel="Phone", subtotal="100", total="90"):
+    return [order_id, when, "C1", "منى", "", channel, subtotal, "10", "0", "0", total, "Paid", ""]
+
+@pytest.fixture
+def storage(tmp_path):
+    db = SQLiteStorage(str(tmp_path / "pos.db"))
+    db.write_values("Products", [SCHEMAS["Products"],
+                                 ["P1", "Lipstick", "120", "10", "5", "Yes", ""],
+                                 ["P2", "Mascara", "50", "3", "5", "Yes", ""]])
+    yield db
+    db.conn.close()
+
+def test_sqlite_round_trip(storage):
+    values = storage.read_values("Products")
+    assert values[0] == SCHEMAS["Products"]
+    assert values[1:] == [["P1", "Lipstick", "120", "10", "5", "Yes", ""],
+                          ["P2", "Mascara", "50", "3", "5", "Yes", ""]]
+    assert storage.read_column("Products", "SKU") == ["P1", "P2"]
+
+    # A rewrite replaces every row; short rows are padded to the schema
+    storage.write_values("Products", [SCHEMAS["Products"], ["P3", "Blush"]])
+    assert storage.read_values("Products")[1:] == [["P3", "Blush", "", "", "", "", ""]]
+
+def test_sqlite_data_survives_reopen(storage, tmp_path):
+    storage.commit({"Customers": [["C1", "أحمد علي", "01012345678", "", ""]]}, [])
+    reopened = SQLiteStorage(str(tmp_path / "pos.db"))
+    try:
+        assert reopened.read_values("Customers")[1:] == [["C1", "أحمد علي", "01012345678", "", ""]]
+        assert reopened.key == storage.key
+    finally:
+        reopened.conn.close()
+
+def test_sqlite_append_and_read_tail(storage):
+    storage.commit({"StockMovements": [["2026-10-01 10:00:00", "P1", "5", "Purchase", "", ""]]}, [])
+    storage.commit({"StockMovements": [["2026-10-01 11:00:00", "P1", "-1", "Sale", "ORD1", ""],
+                                       ["2026-10-01 12:00:00", "P2", "-2", "Sale", "ORD2", ""]]}, [])
+    header, rows = storage.read_tail("StockMovements", 1)
+    assert header == SCHEMAS["StockMovements"]
+    assert [r[4] for r in rows] == ["ORD1", "ORD2"]
+    assert storage.read_many({"StockMovements": 3, "Products": 0}) == {
+        "StockMovements": (SCHEMAS["StockMovements"], []),
+        "Products": storage.read_tail("Products", 0),
+    }
+
+def test_sqlite_commit_checkout(storage):
+    appends = {
+        "Orders": [order_row("ORD1")],
+        "OrderItems": [["ORD1", "P1", "Lipstick", "2", "50", "100"]],
+        "StockMovements": [["2026-10-01 10:00:00", "P1", "-2", "Sale", "ORD1", ""]],
+    }
+    written, updates = storage.commit(appends, [], {"P1": -2, "P9": -1})
+    assert storage.read_column("Orders", "OrderID") == ["ORD1"]
+    assert storage.read_column("OrderItems", "Qty") == ["2"]
+    assert storage.read_column("StockMovements", "Reference") == ["ORD1"]
+    # Stock changes are relative and reported back as the cells they wrote; unknown SKUs are skipped
+    assert storage.read_column("Products", "InStock") == ["8", "3"]
+    assert ("Products", 0, "InStock", "8") in updates
+    # The first order of a day and channel adds its DailySales row in the same transaction
+    assert storage.read_values("DailySales")[1:] == [["2026-10-01", "Phone", "1", "100.0", "10.0", "0.0", "0.0", "90.0"]]
+    assert written["DailySales"] == storage.read_values("DailySales")[1:]
+
+    written, updates = storage.commit({"Orders": [order_row("ORD2", when="2026-10-01 18:00:00", total="40",
+                                                            subtotal="50")]}, [], {"P1": -1})
+    assert storage.read_values("DailySales")[1:] == [["2026-10-01", "Phone", "2", "150.0", "20.0", "0.0", "0.0", "130.0"]]
+    assert "DailySales" not in written
+    assert ("DailySales", 0, "Orders", "2") in updates
+    assert storage.read_column("Products", "InStock") == ["7", "3"]
+
+def test_sqlite_commit_rolls_back_on_error(storage):
+    with pytest.raises(sqlite3.OperationalError):
+        storage.commit({"Orders": [order_row("ORD1")]}, [("Products", 0, "NoSuchColumn", "x")], {"P1": -2})
+    assert storage.read_column("Orders", "OrderID") == []
+    assert storage.read_column("Products", "InStock") == ["10", "3"]
+    assert storage.read_values("DailySales")[1:] == []
+
+def test_sqlite_rebuild_daily_sales_once(storage):
+    storage.commit({"Orders": [order_row("ORD1"), order_row("ORD2", channel="Instagram")]}, [])
+    assert storage.rebuild_daily_sales() is True
+    assert [r[:3] for r in storage.read_values("DailySales")[1:]] == [["2026-10-01", "Instagram", "1"],
+                                                                       ["2026-10-01", "Phone", "1"]]
+    assert [DAILY_SALES_BUILT_KEY, "1"] in storage.read_values("Settings")[1:]
+    assert storage.rebuild_daily_sales() is False
+
+# ---------- Sheets Storage ----------
+class FakeResponse:
+    def __init__(self, message):
+        self.status_code = 400
+        self.text = message
+
+    def json(self):
+        return {"error": {"code": 400, "message": self.text, "status": "INVALID_ARGUMENT"}}
+
+def api_error(message):
+    return gspread.exceptions.APIError(FakeResponse(message))
+
+class FakeWorksheet:
+    def __init__(self, sheet_id):
+        self.id = sheet_id
+
+class FakeSpreadsheet:
+    """The parts of the Sheets API SheetsStorage's counter writes use, applied all-or-nothing.
+
+    `before_batch(sh)` runs ahead of each batchUpdate, e.g. to play another terminal's write.
+    """
+    id = "fake"
+
+    def __init__(self, **sheets):
+        self.sheets = {name: {"id": i + 1, "rows": [list(SCHEMAS[name])] + [list(r) for r in rows]}
+                       for i, (name, rows) in enumerate(sheets.items())}
+        self.before_batch = None
+        self.batches = 0
+
+    def storage(self):
+        validated = {(self.id, name): FakeWorksheet(sheet["id"]) for name, sheet in self.sheets.items()}
+        return SheetsStorage(self, None, validated)
+
+    def column(self, name, col):
+        return [row[SCHEMAS[name].index(col)] for row in self.sheets[name]["rows"][1:]]
+
+    def values_batch_get(self, ranges):
+        result = []
+        for rng in ranges:
+            title, first_col, first_row, last_col = re.fullmatch(r"'(.+)'!([A-Z])(\d+)(?::([A-Z]))?\d*", rng).groups()
+            if title not in self.sheets:
+                raise api_error(f"Unable to parse range: {rng}")
+            lo, hi = ord(first_col) - 65, ord(last_col or first_col) - 65
+            rows = [row[lo:hi + 1] for row in self.sheets[title]["rows"][int(first_row) - 1:]]
+            result.append({"range": rng, "values": rows} if rows else {"range": rng})
+        return {"valueRanges": result}
+
+    def fetch_sheet_metadata(self, params=None):
+        return {"sheets": [{"properties": {"title": t, "sheetId": s["id"]}} for t, s in self.sheets.items()]}
+
+    def _by_id(self, sheet_id, i, kind):
+        for sheet in self.sheets.values():
+            if sheet["id"] == sheet_id:
+                return sheet
+        raise api_error(f"Invalid requests[{i}].{kind}: No grid with id: {sheet_id}")
+
+    def batch_update(self, body):
+        if self.before_batch is not None:
+            self.before_batch(self)
+        self.batches += 1
+        saved = copy.deepcopy(self.sheets)
+        try:
+            for i, request in enumerate(body["requests"]):
+                self._apply(i, request)
+        except Exception:
+            self.sheets = saved
+            raise
+
+    def _apply(self, i, request):
+        (kind, args), = request.items()
+        if kind == "deleteSheet":
+            sheet = self._by_id(args["sheetId"], i, kind)
+            self.sheets = {t: s for t, s in self.sheets.items() if s is not sheet}
+        elif kind == "addSheet":
+            props = args["properties"]
+            if props["title"] in self.sheets:
+                raise api_error(f'Invalid requests[{i}].addSheet: A sheet with the name "{props["title"]}" already exists.')
+            self.sheets[props["title"]] = {"id": props["sheetId"], "rows": []}
+        elif kind == "appendCells":
+            rows = self._by_id(args["sheetId"], i, kind)["rows"]
+            rows += [[v["userEnteredValue"]["stringValue"] for v in r["values"]] for r in args["rows"]]
+        elif kind == "updateCells":
+            rows = self._by_id(args["start"]["sheetId"], i, kind)["rows"]
+            r, c = args["start"]["rowIndex"], args["start"]["columnIndex"]
+            while len(rows) <= r:
+                rows.append([])
+            rows[r] += [""] * (c + 1 - len(rows[r]))
+            rows[r][c] = args["rows"][0]["values"][0]["userEnteredValue"]["stringValue"]
+        elif kind == "deleteDimension":
+            span = args["range"]
+            del self._by_id(span["sheetId"], i, kind)["rows"][span["startIndex"]:span["endIndex"]]
+        else:
+            raise api_error(f"Invalid requests[{i}]: unsupported {kind}")
+
+def sale(order_id, sku="P1", qty=1):
+    """storage.commit arguments of one checkout."""
+    return ({"Orders": [order_row(order_id)], "OrderItems": [[order_id, sku, "Lipstick", str(qty), "50", "50"]]},
+            [], {sku: -qty})
+
+@pytest.fixture
+def sh(monkeypatch):
+    monkeypatch.setattr(pos_core.time, "sleep", lambda seconds: None)
+    return FakeSpreadsheet(Products=[["P1", "Lipstick", "120", "10", "5", "Yes", ""]], Orders=[], OrderItems=[],
+                           DailySales=[], Settings=[])
+
+def revision(sh):
+    return int(sh.sheets[REVISION_SHEET]["rows"][0][0])
+
+def test_sheets_forget_checks_drops_every_header_check(sh):
+    storage = sh.storage()
+    storage["Orders"]
+    storage.forget_checks()
+    assert not storage._cache
+    assert not storage.validated
+
+def test_sheets_first_counter_write_creates_the_revision_sheet(sh):
+    sh.storage().commit(*sale("ORD1", qty=2))
+    assert sh.column("Products", "InStock") == ["8"]
+    assert sh.column("Orders", "OrderID") == ["ORD1"]
+    assert sh.column("DailySales", "Orders") == ["1"]
+    # The revision sheet's one cell names its own id
+    assert revision(sh) == sh.sheets[REVISION_SHEET]["id"]
+    first = revision(sh)
+    sh.storage().commit(*sale("ORD2"))
+    assert sh.column("Products", "InStock") == ["7"]
+    assert revision(sh) != first
+
+def test_sheets_stale_revision_retries_on_fresh_counters(sh):
+    sh.storage().commit(*sale("ORD1"))
+    other = sh.storage()
+    def other_terminal_sells_first(sh):
+        sh.before_batch = None
+        other.commit(*sale("ORD2", qty=3))
+    sh.before_batch = other_terminal_sells_first
+    sh.storage().commit(*sale("ORD3", qty=2))
+    # Both sales count: 10 - 1 - 3 - 2, and no sale was written twice
+    assert sh.column("Products", "InStock") == ["4"]
+    assert sh.column("Orders", "OrderID") == ["ORD1", "ORD2", "ORD3"]
+    assert sh.column("DailySales", "Orders") == ["3"]
+
+def test_sheets_first_writes_race_on_creating_the_revision_sheet(sh):
+    other = sh.storage()
+    def other_terminal_writes_first(sh):
+        sh.before_batch = None
+        other.commit(*sale("ORD1"))
+    sh.before_batch = other_terminal_writes_first
+    sh.storage().commit(*sale("ORD2"))
+    assert sh.column("Products", "InStock") == ["8"]
+    assert sh.column("Orders", "OrderID") == ["ORD1", "ORD2"]
+
+def test_sheets_other_400_errors_are_raised(sh):
+    storage = sh.storage()
+    storage.commit(*sale("ORD1"))
+    def bad_request(sh):
+        raise api_error("Invalid requests[3].updateCells: Invalid value")
+    sh.before_batch = bad_request
+    with pytest.raises(gspread.exceptions.APIError):
+        storage.commit(*sale("ORD2"))
+    assert sh.column("Products", "InStock") == ["9"]
+    # A read that fails for another reason than the missing revision sheet is not taken as "first write"
+    sh.before_batch = None
+    del sh.sheets["Products"]
+    with pytest.raises(gspread.exceptions.APIError):
+        storage.commit(*sale("ORD3"))
+
+def test_sheets_counter_write_gives_up_after_its_attempts(sh):
+    storage = sh.storage()
+    storage.commit(*sale("ORD1"))
+    def always_someone_else(sh):
+        # Another terminal swaps the revision between every read and write
+        sheet = sh.sheets.pop(REVISION_SHEET)
+        sh.sheets[REVISION_SHEET] = dict(sheet, id=sheet["id"] + 1)
+    sh.before_batch = always_someone_else
+    before = sh.batches
+    with pytest.raises(RuntimeError):
+        storage.commit(*sale("ORD2"))
+    assert sh.batches - before == COUNTER_WRITE_ATTEMPTS
+    assert sh.column("Products", "InStock") == ["9"]
+    assert sh.column("Orders", "OrderID") == ["ORD1"]
+
+def test_sheets_rebuild_daily_sales_includes_a_racing_checkout(sh):
+    sh.sheets["Orders"]["rows"] += [order_row("ORD1"), order_row("ORD2", channel="Instagram")]
+    storage = sh.storage()
+    def checkout_during_rebuild(sh):
+        sh.before_batch = None
+        storage.commit(*sale("ORD3"))
+    sh.before_batch = checkout_during_rebuild
+    assert storage.rebuild_daily_sales() is True
+    daily = sh.sheets["DailySales"]["rows"][1:]
+    assert sorted((r[1], r[2]) for r in daily) == [("Instagram", "1"), ("Phone", "2")]
+    assert [r for r in sh.sheets["Settings"]["rows"][1:] if r[0] == DAILY_SALES_BUILT_KEY] == [[DAILY_SALES_BUILT_KEY, "1"]]
+    assert storage.rebuild_daily_sales() is False
+
+# ---------- Write-behind Outbox ----------
+class Crash(BaseException):
+    """The process dying in the middle of a flush."""
+
+class CountingStorage:
+    """Storage that records every commit it receives."""
+    key = "counting"
+
+    def __init__(self):
+        self.sends = []
+        self.order_ids = []
+
+    def commit(self, appends, cell_updates, stock_deltas=None):
+        self.sends.append((appends, stock_deltas))
+        self.order_ids += [row[0] for row in appends.get("Orders", [])]
+        return appends, cell_updates
+
+    def read_column(self, name, col):
+        assert (name, col) == ("Orders", "OrderID")
+        return list(self.order_ids)
+
+class InlineCoalescer:
+    """Sends each batch right away; `fail` is raised after the write lands (or instead of it)."""
+    def __init__(self, fail=None, before_write=False, during=None):
+        self.fail, self.before_write, self.during = fail, before_write, during
+
+    def submit(self, storage, appends, cell_updates, stock_deltas):
+        if self.during is not None:
+            self.during()
+        if self.fail is not None and self.before_write:
+            raise self.fail
+        storage.commit(appends, cell_updates, stock_deltas)
+        if self.fail is not None:
+            raise self.fail
+        future = Future()
+        future.set_result(None)
+        return future
+
+@pytest.fixture
+def make_outbox(tmp_path, monkeypatch):
+    # Tests drive flush_once themselves; no background flusher
+    monkeypatch.setattr(Outbox, "_run", lambda self: None)
+    def make(storage, coalescer=None):
+        outbox = Outbox(str(tmp_path / "outbox.db"))
+        outbox.storage, outbox.coalescer = storage, coalescer or InlineCoalescer()
+        return outbox
+    return make
+
+def checkout(outbox, order_id, sku="P1", qty=1):
+    outbox.enqueue(order_id, {"Orders": [order_row(order_id)],
+                              "OrderItems": [[order_id, sku, "Lipstick", str(qty), "50", str(50 * qty)]]},
+                   {sku: -qty})
+
+def expire_claims(outbox):
+    with outbox.lock:
+        outbox.conn.execute("UPDATE outbox SET next_attempt = 0 WHERE done_at IS NULL")
+
+def test_outbox_enqueue_is_durable_and_idempotent(make_outbox):
+    storage = CountingStorage()
+    outbox = make_outbox(storage)
+    checkout(outbox, "ORD1")
+    checkout(outbox, "ORD1")  # a double-clicked checkout
+    checkout(outbox, "ORD2", qty=2)
+    outbox.conn.close()
+
+    # Still queued after a restart
+    outbox = make_outbox(storage)
+    assert outbox.stats()[0] == 2
+    assert outbox.pending_stock_deltas() == {"P1": -3}
+    assert outbox.flush_once() == 2
+    assert len(storage.sends) == 1
+    appends, stock_deltas = storage.sends[0]
+    assert [row[0] for row in appends["Orders"]] == ["ORD1", "ORD2"]
+    assert stock_deltas == {"P1": -3}
+    assert outbox.stats() == (0, None)
+    assert outbox.flush_once() == 0
+    assert len(storage.sends) == 1
+
+def test_outbox_claim_is_exclusive(make_outbox):
+    storage = CountingStorage()
+    first = make_outbox(storage)
+    second = make_outbox(storage)
+    checkout(first, "ORD1")
+    # While the first flusher is sending, a second one finds nothing to claim
+    seen = []
+    first.coalescer = InlineCoalescer(during=lambda: seen.append(second.flush_once()))
+    assert first.flush_once() == 1
+    assert seen == [0]
+    assert storage.order_ids == ["ORD1"]
+
+def test_outbox_crash_after_write_is_not_sent_again(make_outbox):
+    storage = CountingStorage()
+    outbox = make_outbox(storage, InlineCoalescer(fail=Crash()))
+    checkout(outbox, "ORD1")
+    with pytest.raises(Crash):
+        outbox.flush_once()
+    assert storage.order_ids == ["ORD1"]
+    outbox.conn.close()
+
+    restarted = make_outbox(storage)
+    # The dead flusher's claim still holds
+    assert restarted.flush_once() == 0
+    expire_claims(restarted)
+    # Re-claimed: the order is already in storage, so it is marked done without a second send
+    assert restarted.flush_once() == 1
+    assert storage.order_ids == ["ORD1"]
+    assert len(storage.sends) == 1
+    assert restarted.stats()[0] == 0
+
+def test_outbox_crash_before_write_is_sent_once(make_outbox):
+    storage = CountingStorage()
+    outbox = make_outbox(storage, InlineCoalescer(fail=Crash(), before_write=True))
+    checkout(outbox, "ORD1")
+    with pytest.raises(Crash):
+        outbox.flush_once()
+    assert storage.sends == []
+    outbox.conn.close()
+
+    restarted = make_outbox(storage)
+    expire_claims(restarted)
+    assert restarted.flush_once() == 1
+    assert restarted.flush_once() == 0
+    assert storage.order_ids == ["ORD1"]
+
+def test_outbox_lost_response_is_retried_without_resending(make_outbox):
+    storage = CountingStorage()
+    outbox = make_outbox(storage, InlineCoalescer(fail=TimeoutError("response lost")))
+    checkout(outbox, "ORD1")
+    assert outbox.flush_once() == 0
+    assert outbox.last_error == "response lost"
+    assert outbox.stats()[0] == 1
+
+    outbox.coalescer = InlineCoalescer()
+    expire_claims(outbox)
+    assert outbox.flush_once() == 1
+    assert len(storage.sends) == 1
+    assert outbox.stats()[0] == 0
+
+# ---------- Customer Search ----------
+def customers(rows):
+    return pd.DataFrame([list(r) + ["", ""] for r in rows], columns=["CustomerID", "Name", "Phone", "Address", "Notes"])
+
+@pytest.fixture
+def index():
+    index = CustomerSearchIndex()
+    index.sync(1, customers([
+        ("C1", "أحمد علي", "01012345678"),
+        ("C2", "فاطمة حسن", "+20 100 555 1234"),
+        ("C3", "إيمان محمود", "0020 111 222 3333"),
+        ("C4", "محمد سامي", ""),
+    ]))
+    return index
+
+def test_normalize_arabic_folds_letter_variants():
+    assert normalize_arabic("أحمد") == normalize_arabic("احمد") == normalize_arabic("أَحْمَد")
+    assert normalize_arabic("فاطمة") == normalize_arabic("فاطمه")
+    assert normalize_arabic("مصطفى") == normalize_arabic("مصطفي")
+
+def test_normalize_phone_drops_country_code_and_leading_zero():
+    assert normalize_phone("01012345678") == normalize_phone("+20 101 234 5678") == "1012345678"
+    assert normalize_phone("0020-101-234-5678") == normalize_phone("٠١٠١٢٣٤٥٦٧٨") == "1012345678"
+
+def test_normalize_phone_keeps_short_numbers_whole():
+    assert normalize_phone("+20 10 1234") == "20101234"
+    assert normalize_phone("123") == "123"
+
+def test_normalize_phone_landline():
+    assert normalize_phone("+20 2 2345 6789") == normalize_phone("02 2345 6789") == "223456789"
+    assert normalize_phone("0020 2 2345 6789") == "223456789"
+
+@pytest.mark.parametrize("query", ["أحمد", "احمد", "احمدد", "أحمد على"])
+def test_search_name_variants_and_typos(index, query):
+    assert index.search(query)[0] == 0
+
+def test_search_name_ta_marbuta(index):
+    assert index.search("فاطمه")[0] == 1
+    assert index.search("ايمان")[0] == 2
+
+def test_search_finds_every_customer_with_the_word(index):
+    assert sorted(index.search("محمد")) == [2, 3]
+
+@pytest.mark.parametrize("query, expected", [
+    ("01012345678", 0),
+    ("+201012345678", 0),
+    ("1012345678", 0),
+    ("5678", 0),            # last digits
+    ("010", 0),             # typed from the start
+    ("01005551234", 1),
+    ("+20 100 555 1234", 1),
+    ("3333", 2),
+    ("٠١١١٢٢٢٣٣٣٣", 2),
+])
+def test_search_phone_formats(index, query, expected):
+    assert index.search(query)[0] == expected
+
+def test_search_index_follows_edits(index):
+    index.sync(2, customers([
+        ("C1", "أحمد علي", "01012345678"),
+        ("C2", "سارة حسن", "+20 100 555 1234"),
+        ("C3", "إيمان محمود", "0020 111 222 3333"),
+    ]))
+    assert index.search("فاطمه") == []
+    assert index.search("ساره")[0] == 1
+    assert index.search("محمود") == [2]
+    assert index.search("1234") == [1]
+
+# ---------- Sheet Cache ----------
+class SheetData:
+    """Storage holding sheets as lists of rows; `gate` (an Event) holds reads until it is set."""
+    key = "sheets"
+    snapshots = False
+
+    def __init__(self, **sheets):
+        self.sheets = {name: [list(r) for r in rows] for name, rows in sheets.items()}
+        self.reads = []
+        self.tokens_read = 0
+        self.gate = None
+
+    def busy(self):
+        return False
+
+    def modified(self):
+        self.tokens_read += 1
+        return "token"
+
+    def read_tail(self, name, start):
+        return list(SCHEMAS[name]), [list(r) for r in self.sheets.get(name, [])[start:]]
+
+    def read_many(self, starts):
+        self.reads.append(dict(starts))
+        if self.gate is not None:
+            self.gate.wait(5)
+        return {name: self.read_tail(name, start) for name, start in starts.items()}
+
+def product_row(sku, stock="10", active="Yes"):
+    return [sku, f"Product {sku}", "50", stock, "5", active, ""]
+
+def test_sheet_cache_write_through_does_not_wait_for_a_slow_read():
+    data = SheetData(Products=[product_row("P1")])
+    cache = SheetCache()
+    cache.get(data, "Products")
+    cache.invalidate(data.key, ["Products"])
+    data.gate = threading.Event()
+    reader = threading.Thread(target=cache.get, args=(data, "Products"))
+    reader.start()
+    while len(data.reads) < 2:
+        pass
+    # The refresh is stuck in its read; the write-through still goes in at once
+    writer = threading.Thread(target=cache.apply_commit, args=(data.key, {"Products": [product_row("P2")]}, []))
+    writer.start()
+    writer.join(1)
+    assert not writer.is_alive()
+    data.gate.set()
+    reader.join(5)
+    # The read started before the write finished, so it must not replace the written entry
+    assert list(cache.snapshot(data.key, "Products")[0]["SKU"]) == ["P1", "P2"]
+
+def test_sheet_cache_refresh_is_one_read(tmp_path):
+    data = SheetData(Products=[product_row("P1")])
+    data.snapshots = True
+    cache = SheetCache(snapshots=SnapshotStore(str(tmp_path)))
+    cache.get(data, "Products")
+    for _ in range(3):
+        cache.invalidate(data.key, ["Products"])
+        cache.get(data, "Products")
+    # Only the one startup check asks for the storage token; page refreshes are a single read each
+    assert len(data.reads) == 4
+    assert data.tokens_read <= 1
+
+def test_sheet_cache_counts_derived_values_and_old_versions():
+    data = SheetData(Products=[product_row(f"P{i}") for i in range(200)])
+    cache = SheetCache()
+    typed = cache.typed(data, "Products")
+    before = dict((r["sheet"], r["bytes"]) for r in cache.stats(data.key)[0])["Products"]
+    # An index that shares the typed frame adds little; a sorted copy adds a whole frame
+    cache.derive(data, "Products", "by_sku", lambda df: (df, df.groupby("SKU").indices))
+    cache.derive(data, "Products", "sorted", lambda df: df.sort_values("Name"))
+    after = dict((r["sheet"], r["bytes"]) for r in cache.stats(data.key)[0])["Products"]
+    assert after - before >= cache.entries[(data.key, "Products")]["typed_bytes"]
+    # Products is a keyed sheet: the version it replaces stays for diffs and is counted too
+    cache.apply_commit(data.key, {}, [("Products", 0, "InStock", "9")])
+    entry = cache.entries[(data.key, "Products")]
+    assert entry["base_bytes"] > 0
+    assert cache.stats(data.key)[1] == cache._entry_bytes(entry)
+    assert typed is not entry["typed"]
+
+def movement(i, reason="Sale"):
+    return [f"2026-10-01 10:{i % 60:02d}:00", f"P{i % 3}", str(-i), reason, f"ORD{i}", ""]
+
+def test_sheet_cache_reads_only_new_ledger_rows(monkeypatch):
+    data = SheetData(StockMovements=[movement(i) for i in range(5)])
+    cache = SheetCache()
+    assert len(cache.get(data, "StockMovements")) == 5
+    data.sheets["StockMovements"] += [movement(5), movement(6)]
+    # Past the TTL the refresh starts at the last row it has, to check it is still there
+    now = pos_core.time.time()
+    monkeypatch.setattr(pos_core.time, "time", lambda: now + SHEET_CACHE_TTL + 1)
+    frame = cache.get(data, "StockMovements")
+    assert data.reads == [{"StockMovements": 0}, {"StockMovements": 4}]
+    assert list(frame["Reference"]) == [f"ORD{i}" for i in range(7)]
+
+@pytest.mark.parametrize("change", ["shrink", "edit", "header"])
+def test_sheet_cache_reloads_a_ledger_that_was_not_only_appended_to(change):
+    data = SheetData(StockMovements=[movement(i) for i in range(5)])
+    cache = SheetCache()
+    cache.get(data, "StockMovements")
+    if change == "shrink":
+        del data.sheets["StockMovements"][3:]
+    elif change == "edit":
+        data.sheets["StockMovements"][4][4] = "EDITED"
+    else:
+        data.read_tail = lambda name, start: (["Wrong"] + SCHEMAS[name][1:], data.sheets[name][start:])
+    cache.invalidate(data.key, ["StockMovements"])
+    frame = cache.get(data, "StockMovements")
+    if change == "header":
+        # A wrong header row gives an empty frame and the page warns, rather than misreading columns
+        assert frame.empty and not cache.header_ok(data.key, "StockMovements")
+    else:
+        # The delta read found its last row changed or gone, so the whole sheet was read again
+        assert data.reads[-1] == {"StockMovements": 4}
+        assert list(frame["Reference"]) == [r[4] for r in data.sheets["StockMovements"]]
+
+def test_sheet_cache_write_through_matches_a_fresh_read():
+    data = SheetData(Products=[product_row(f"P{i}") for i in range(5)])
+    cache = SheetCache()
+    cache.typed(data, "Products")
+    # Cell updates, including a category value the sheet has not had yet, plus appended rows
+    updates = [("Products", 1, "InStock", "7"), ("Products", 2, "Active", "Archived"), ("Products", 3, "Name", "New")]
+    appends = {"Products": [product_row("P5", active="No"), product_row("P6", active="Maybe")]}
+    cache.apply_commit(data.key, appends, updates)
+    for _, pos, col, value in updates:
+        data.sheets["Products"][pos][SCHEMAS["Products"].index(col)] = value
+    data.sheets["Products"] += appends["Products"]
+
+    fresh = _type_frame("Products", pd.DataFrame(data.sheets["Products"], columns=SCHEMAS["Products"]))
+    pd.testing.assert_frame_equal(cache.typed(data, "Products"), fresh)
+    raw, version = cache.snapshot(data.key, "Products")
+    assert raw.values.tolist() == data.sheets["Products"]
+    assert version == cache.typed_at(data, "Products")[1]
+    # Served from the write-through; only the first load read the sheet
+    assert len(data.reads) == 1
+
+def test_sheet_cache_write_through_extends_derived_values():
+    data = SheetData(StockMovements=[movement(i) for i in range(4)])
+    cache = SheetCache()
+    build = lambda df: {k: list(v) for k, v in df.groupby("SKU").indices.items()}
+    def extend(value, df, start):
+        value = {k: list(v) for k, v in value.items()}
+        for pos in range(start, len(df)):
+            value.setdefault(df["SKU"].iat[pos], []).append(pos)
+        return value
+    cache.derive(data, "StockMovements", "by_sku", build, extend)
+    cache.derive(data, "StockMovements", "count", len)
+    cache.apply_commit(data.key, {"StockMovements": [movement(4), movement(5)]}, [])
+    entry = cache.entries[(data.key, "StockMovements")]
+    # Values with an extend function survive the append; the others are built again on next use
+    assert set(entry["derived"]) == {"by_sku"}
+    assert cache.derive(data, "StockMovements", "by_sku", build, extend) == build(cache.typed(data, "StockMovements"))
+    assert cache.derive(data, "StockMovements", "count", len) == 6
+
+def test_sheet_cache_write_through_past_the_cached_rows_drops_the_entry():
+    data = SheetData(Products=[product_row("P1")])
+    cache = SheetCache()
+    cache.get(data, "Products")
+    cache.apply_commit(data.key, {}, [("Products", 3, "InStock", "1")])
+    assert cache.snapshot(data.key, "Products") == (None, 0)
+
+def test_sheet_cache_evicts_least_recently_used():
+    data = SheetData(Products=[product_row(f"P{i}") for i in range(50)],
+                     Customers=[[f"C{i}", "name", "0100", "", ""] for i in range(50)],
+                     Settings=[["BusinessName", "Shop"]])
+    sizes = SheetCache()
+    sizes.load(data, ["Products", "Customers", "Settings"])
+    # Room for any two of the three sheets
+    cache = SheetCache(max_bytes=sizes.stats(data.key)[1] - 1)
+    cache.get(data, "Products")
+    cache.get(data, "Customers")
+    cache.get(data, "Products")  # now Customers is the least recently used
+    cache.get(data, "Settings")
+    assert set(k[1] for k in cache.entries) == {"Products", "Settings"}
+    assert {row["sheet"]: row["evictions"] for row in cache.stats(data.key)[0]}["Customers"] == 1
+    assert cache.stats(data.key)[1] <= cache.max_bytes
+    # An evicted sheet is simply read again
+    assert len(cache.get(data, "Customers")) == 50